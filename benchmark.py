@@ -0,0 +1,220 @@
+#!/usr/bin/python2.7
+
+PROGRAM_VERSION = "benchmark.py, part of SCCULS preview-1"
+
+import libscculs
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import numpy
+
+# simulates one ultrametric tree, by joining lineages from the tips back to the root
+# under both the Yule and coalescent models every pair of lineages is equally likely to be joined next, and
+# only the waiting times differ: exponential with rate k under a Yule process, and rate k(k - 1) / 2 under
+# the coalescent, where k is the number of lineages
+# with probability 1 - diversity, the two oldest lineages (the last two, as each new lineage is inserted at the
+# front) are joined instead of a random pair, which with a diversity of 0 always gives the same balanced
+# topology, and with a diversity of 1 a topology drawn from the model
+def simulate_tree(taxon_names, model, diversity, rng):
+	lineages = [(taxon_name, 0.0) for taxon_name in taxon_names]
+
+	node_height = 0.0
+	while len(lineages) > 1:
+		n_lineages = len(lineages)
+		if model == "yule":
+			node_height += rng.expovariate(n_lineages)
+		else:
+			node_height += rng.expovariate(n_lineages * (n_lineages - 1) / 2.0)
+
+		if rng.random() < diversity:
+			i, j = rng.sample(range(n_lineages), 2)
+		else:
+			i, j = n_lineages - 2, n_lineages - 1
+
+		child1_newick, child1_height = lineages[i]
+		child2_newick, child2_height = lineages[j]
+		for k in sorted([i, j], reverse = True):
+			lineages.pop(k)
+
+		# the order of children is random, so the same topology is written in many ways
+		children = ["%s:%.6f" % (child1_newick, node_height - child1_height), "%s:%.6f" % (child2_newick, node_height - child2_height)]
+		rng.shuffle(children)
+		lineages.insert(0, ("(" + ",".join(children) + ")", node_height))
+
+	return lineages[0][0] + ";"
+
+# writes a sample of simulated trees to a newick file (one tree per line) or to a BEAST style nexus file,
+# where taxa are numbered in a translate block
+def write_sample(sample_path, n_taxa, n_trees, model, diversity, sample_format, seed):
+	rng = random.Random(seed)
+	taxon_names = ["t%d" % (i) for i in range(n_taxa)]
+
+	sample_file = open(sample_path, "w")
+	if sample_format == "nexus":
+		tree_taxon_names = [str(i + 1) for i in range(n_taxa)]
+		translate_rows = ["\t\t%s %s" % (tree_taxon_names[i], taxon_names[i]) for i in range(n_taxa)]
+		sample_file.write("#NEXUS\n\nBegin taxa;\n\tDimensions ntax=%d;\n\tTaxlabels\n" % (n_taxa))
+		for taxon_name in taxon_names:
+			sample_file.write("\t\t%s\n" % (taxon_name))
+
+		sample_file.write("\t\t;\nEnd;\n\nBegin trees;\n\tTranslate\n")
+		sample_file.write(",\n".join(translate_rows) + "\n\t\t;\n")
+		for i in range(n_trees):
+			sample_file.write("tree STATE_%d = [&R] %s\n" % (i, simulate_tree(tree_taxon_names, model, diversity, rng)))
+
+		sample_file.write("End;\n")
+	else:
+		for i in range(n_trees):
+			sample_file.write(simulate_tree(taxon_names, model, diversity, rng) + "\n")
+
+	sample_file.close()
+
+# returns the start of a stage, a (wall time, os.times()) pair
+def start_stage():
+	return time.time(), os.times()
+
+# appends the wall seconds, CPU seconds of this process, and CPU seconds of finished worker processes (as counted
+# by os.times, the same way as StageProfiler) since stage_start to stage_times
+def end_stage(stage_times, stage_name, stage_start):
+	wall_start, times_start = stage_start
+	times_end = os.times()
+	stage_times.append((stage_name, {
+		"wall": time.time() - wall_start,
+		"cpu": (times_end[0] + times_end[1]) - (times_start[0] + times_start[1]),
+		"children_cpu": (times_end[2] + times_end[3]) - (times_start[2] + times_start[3]),
+	}))
+
+# runs each stage of the usual summary of a sample, and returns the wall and CPU seconds of each stage
+# together with the sizes of the sample
+def benchmark_sample(sample_path, output_folder, n_jobs, derivation_method, max_topologies):
+	stage_times = []
+
+	stage_start = start_stage()
+	newick_strings = libscculs.trees_from_path(sample_path)
+	end_stage(stage_times, "reading", stage_start)
+
+	stage_start = start_stage()
+	ultrametric_sample = libscculs.UltrametricSample(newick_strings, "", 0.0, n_jobs)
+	end_stage(stage_times, "ultrametric_sample", stage_start)
+
+	taxon_order = ultrametric_sample.taxon_order
+	n_taxa = len(taxon_order)
+
+	stage_start = start_stage()
+	topology_set, topology_counts, cc_set, clade_set = libscculs.calculate_topology_probabilities(ultrametric_sample)
+	end_stage(stage_times, "calculate_topology_probabilities", stage_start)
+
+	stage_start = start_stage()
+	cc_set.probabilities_from_counts()
+	end_stage(stage_times, "cc_probabilities", stage_start)
+
+	stage_start = start_stage()
+	if derivation_method == "k-best":
+		output_topology_set = libscculs.derive_kbest_topologies(cc_set, taxon_order, max_topologies, 1.0)
+	else:
+		output_topology_set = libscculs.derive_best_topologies(cc_set, taxon_order, max_topologies, 1.0)
+	end_stage(stage_times, "derive_topologies", stage_start)
+
+	stage_start = start_stage()
+	output_topology_set.probabilities_from_ccs(cc_set)
+	end_stage(stage_times, "topology_probabilities", stage_start)
+
+	stage_start = start_stage()
+	clade_set.derive_clade_probabilities(cc_set, n_taxa)
+	output_topology_set.add_clade_support(clade_set, taxon_order)
+	end_stage(stage_times, "support_annotation", stage_start)
+
+	stage_start = start_stage()
+	for i in range(output_topology_set.n_features):
+		newick_output_file = open(os.path.join(output_folder, "summary.%d" % (i)), "w")
+		newick_output_file.write(output_topology_set.data_array[i] + "\n")
+		newick_output_file.close()
+	end_stage(stage_times, "output", stage_start)
+
+	sample_sizes = {
+		"n_trees": ultrametric_sample.n_trees,
+		"n_unique_topologies": topology_set.n_features,
+		"n_clades": cc_set.n_clades,
+		"n_conditional_clades": cc_set.n_splits,
+		"n_output_topologies": output_topology_set.n_features,
+	}
+
+	return stage_times, sample_sizes
+
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description = "Benchmarks each stage of SCCULS on simulated MCMC samples, and writes the timings as JSON.")
+	arg_parser.add_argument("-v", "--version", action = "version", version = PROGRAM_VERSION)
+	arg_parser.add_argument("--taxa", type = int, nargs = "+", default = [20, 50, 100], help = "The number of taxa of each simulated sample. Default: 20 50 100.")
+	arg_parser.add_argument("--trees", type = int, default = 1000, help = "The number of trees in each simulated sample. Default: 1000.")
+	arg_parser.add_argument("--diversity", type = float, default = 0.1, help = "The probability that each pair of lineages joined while simulating a tree is chosen at random, rather than following one fixed topology. Higher values give more unique topologies. Default: 0.1.")
+	arg_parser.add_argument("--model", type = str, default = "coalescent", choices = ["coalescent", "yule"], help = "The model of node heights used to simulate trees. Default: coalescent.")
+	arg_parser.add_argument("--format", type = str, default = "newick", choices = ["newick", "nexus"], help = "The file format of the simulated samples. Default: newick.")
+	arg_parser.add_argument("--seed", type = int, default = 1, help = "The random seed used to simulate samples. Default: 1.")
+	arg_parser.add_argument("-a", "--derivation-method", type = str, default = "k-best", choices = ["k-best", "best-first"], help = "The method used to derive the most probable topologies. Default: k-best.")
+	arg_parser.add_argument("-l", "--max-topologies", type = int, default = 1, help = "The number of most probable topologies to derive. Default: 1.")
+	arg_parser.add_argument("-j", "--jobs", type = int, default = 1, help = "The number of worker processes used to read and count each sample. Default: 1.")
+	arg_parser.add_argument("-o", "--json-output", metavar = "JSON_OUTPUT_PATH", type = str, help = "Write the results to this file instead of to standard output.")
+	args = arg_parser.parse_args()
+
+	if min(args.taxa) < 3:
+		arg_parser.error("argument --taxa: must be equal to or greater than 3")
+	elif args.trees <= 0:
+		arg_parser.error("argument --trees: must be equal to or greater than 1")
+	elif args.diversity < 0.0 or args.diversity > 1.0:
+		arg_parser.error("argument --diversity: must be between 0.0 and 1.0")
+	elif args.max_topologies <= 0:
+		arg_parser.error("argument -l/--max-topologies: must be equal to or greater than 1")
+	elif args.jobs <= 0:
+		arg_parser.error("argument -j/--jobs: must be equal to or greater than 1")
+
+	benchmark_runs = []
+	benchmark_folder = tempfile.mkdtemp(prefix = "scculs-benchmark-")
+	try:
+		for n_taxa in args.taxa:
+			sys.stderr.write("Benchmarking %d taxa...\n" % (n_taxa))
+			sample_path = os.path.join(benchmark_folder, "sample.%d.%s" % (n_taxa, args.format))
+			write_sample(sample_path, n_taxa, args.trees, args.model, args.diversity, args.format, args.seed)
+
+			stage_times, sample_sizes = benchmark_sample(sample_path, benchmark_folder, args.jobs, args.derivation_method, args.max_topologies)
+			os.remove(sample_path)
+
+			benchmark_run = {
+				"n_taxa": n_taxa,
+				"diversity": args.diversity,
+				"model": args.model,
+				"format": args.format,
+				"seed": args.seed,
+				"stage_order": [stage_name for stage_name, stage_time in stage_times],
+				"stages": dict(stage_times),
+				"total": dict([(time_name, sum([stage_time[time_name] for stage_name, stage_time in stage_times])) for time_name in ("wall", "cpu", "children_cpu")]),
+			}
+			benchmark_run.update(sample_sizes)
+			benchmark_runs.append(benchmark_run)
+	finally:
+		shutil.rmtree(benchmark_folder)
+
+	benchmark_results = {
+		"program_version": PROGRAM_VERSION,
+		"python_version": platform.python_version(),
+		"numpy_version": numpy.__version__,
+		"platform": platform.platform(),
+		"settings": {"n_trees": args.trees, "derivation_method": args.derivation_method, "max_topologies": args.max_topologies, "jobs": args.jobs},
+		"runs": benchmark_runs,
+	}
+
+	if args.json_output is None:
+		json_output_file = sys.stdout
+	else:
+		json_output_file = open(args.json_output, "w")
+
+	json.dump(benchmark_results, json_output_file, indent = 1, sort_keys = True)
+	json_output_file.write("\n")
+
+	if args.json_output is not None:
+		json_output_file.close()
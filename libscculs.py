@@ -1,7 +1,72 @@
 import numpy
-import ete2
-import dendropy
 import math
+import re
+import itertools
+import collections
+import csv
+import gzip
+import bz2
+import io
+import subprocess
+import heapq
+import multiprocessing
+import os
+import json
+import struct
+import hashlib
+import binascii
+import time
+import resource
+import cProfile
+
+# (clade ID, split ID, node height) rows of a columnar tree sample
+node_struct_format = "i4,i4,f8"
+
+# increment whenever the contents of sample cache files change, so old cache files are ignored
+cache_format_version = 4
+array_file_magic = "SCCULS01"
+array_file_alignment = 64
+
+# node heights are summarized a fixed number of rows at a time, so memory-mapped samples are never read whole
+height_chunk_rows = 1 << 20
+# the number of bytes read at a time from a followed MCMC sample, so a long sample is never read into memory whole
+follow_block_size = 1 << 20
+# the median heights of clades with more than this many heights are estimated from a histogram of this many bins
+height_sketch_bins = 256
+
+# the state of the best-first search frontier is recorded once every this many iterations
+frontier_telemetry_interval = 100
+
+# compressed MCMC samples are identified by their first bytes, or failing that by their file name suffix
+compression_magic_bytes = {"gzip": "\x1f\x8b", "bzip2": "BZh", "xz": "\xfd7zXZ\x00"}
+compression_suffixes = {".gz": "gzip", ".bz2": "bzip2", ".xz": "xz"}
+decompression_buffer_size = 1 << 20
+
+# brackets, commas and semicolons are single character tokens, branch lengths keep their leading colon,
+# and comments (including [&R] style annotations) are returned whole so they can be skipped
+newick_token_regex = re.compile(r"\[[^\]]*\]|'(?:[^']|'')*'|[(),;]|:[^(),;\[]*|[^(),;:\[]+")
+
+# the events of iterate_newick_events which have no value, built once instead of for every token
+newick_open_event = ("open", None)
+newick_comma_event = ("comma", None)
+newick_close_event = ("close", None)
+
+# nexus statements end at semicolons, which only count outside of quotes and comments
+nexus_delimiter_regex = re.compile(r"[\[\]';]")
+# the command of the first statement (once comments are removed) is preceded by the nexus header
+nexus_command_regex = re.compile(r"\s*(?:#NEXUS\s*)?([A-Za-z]+)", re.IGNORECASE)
+nexus_word_regex = re.compile(r"'(?:[^']|'')*'|,|[^\s,]+")
+# the name of a tree (which may be preceded by an asterisk) is followed by an equals sign and the tree itself
+nexus_tree_regex = re.compile(r"\s*\*?\s*(?:'(?:[^']|'')*'|[^\s=]+)\s*=(.*)$", re.DOTALL)
+nexus_strip_regex = re.compile(r"'(?:[^']|'')*'|\[[^\[\]]*\]")
+nexus_strip_whitespace_regex = re.compile(r"'(?:[^']|'')*'|\[[^\[\]]*\]|\s+")
+# leaf labels follow an opening bracket or a comma, where internal node labels follow a closing bracket
+newick_leaf_regex = re.compile(r"(?<=[(,])(?:'(?:[^']|'')*'|[^(),:;'\[]+)")
+newick_unsafe_regex = re.compile(r"[\s(),:;'\[\]]")
+
+# raised before any trees are read, when the calibration taxon is not a taxon of the sample
+class CalibrationTaxonError(ValueError):
+	pass
 
 class TopologySample():
 	def __init__(self, newick_strings):
@@ -14,105 +79,241 @@ class TopologySample():
 
 		for i in range(self.n_topologies):
 			ns = self.newick_strings[i]
-			tree = ete2.Tree(ns)
 			if i == 0:
-				taxa = tree.get_leaf_names()
+				taxa = newick_taxon_names(ns)
 				self.taxon_order = sorted(taxa)
+				self.taxon_indices = calculate_taxon_indices(self.taxon_order)
 
 			self.generate_topology_array(ns)
 
 	def generate_topology_array(self, newick_string):
-		topology_root = ete2.Tree(newick_string)
+		node_struct_format = "O,O" # clades and splits are integer bitsets of arbitrary width
 
-		n_taxa = len(self.taxon_order)
-		id_bytes, id_remainder = divmod(n_taxa, 8)
-		if id_remainder == 0:
-			id_size = id_bytes
-		else:
-			id_size = id_bytes + 1
-
-		node_struct_format = "a%d,a%d" % (id_size, id_size)
-
-		topology_values = []
-		self.recurse_node_properties(topology_root, topology_values)
+		topology_values = newick_node_values(newick_string, self.taxon_indices)
 
 		topology_array = numpy.array(topology_values, node_struct_format)
 		topology_array.sort() # clades should be sorted to that topology hashes are consistent
 		self.topology_arrays.append(topology_array)
 
-	def recurse_node_properties(self, node, topology_values):
-		if not node.is_leaf():
-			child1, child2 = node.get_children() # assumes strictly bifurcating tree
-			child1_clade = set(child1.get_leaf_names())
-			child2_clade = set(child2.get_leaf_names())
-
-			self.recurse_node_properties(child1, topology_values)
-			self.recurse_node_properties(child2, topology_values)
-
-			parent_id, split_id = calculate_node_hashes(child1_clade, child2_clade, self.taxon_order)
-			topology_values.append((parent_id, split_id))
-
+# all trees of the sample are stored in one columnar node array, with one (clade ID, split ID, node height) row
+# per internal node. the rows of tree i are node_array[tree_offsets[i]:tree_offsets[i + 1]], and clade IDs
+# index into clade_hashes, where each clade or split is stored once as an integer bitset. the node array is
+# the filled part of node_buffer, which has room for more rows so that trees can be added without copying it
 class UltrametricSample(TopologySample):
-	def __init__(self, newick_strings, calibration_taxon, calibration_date):
+	def __init__(self, newick_strings, calibration_taxon, calibration_date, n_jobs = 1, chunk_size = 1000):
 		self.taxon_order = []
-		self.newick_strings = []
-		self.tree_arrays = []
-
-		self.newick_strings = newick_strings
-		self.n_trees = len(self.newick_strings)
-
-		for i in range(self.n_trees):
-			ns = self.newick_strings[i]
-			tree = ete2.Tree(ns)
-			if i == 0:
-				taxa = tree.get_leaf_names()
-				self.taxon_order = sorted(taxa)
-				if calibration_taxon == "":
-					calibration_taxon = self.taxon_order[0]
-
-			self.generate_tree_array(ns, calibration_taxon, calibration_date)
-
-	def generate_tree_array(self, newick_string, calibration_taxon, calibration_date):
-		tree_root = ete2.Tree(newick_string)
-		calibration_node = tree_root.get_leaves_by_name(calibration_taxon)[0]
-		root_height = tree_root.get_distance(calibration_node) + calibration_date
-
-		n_taxa = len(self.taxon_order)
-		id_bytes, id_remainder = divmod(n_taxa, 8)
-		if id_remainder == 0:
-			id_size = id_bytes
-		else:
-			id_size = id_bytes + 1
-
-		node_struct_format = "a%d,a%d,f8" % (id_size, id_size)
-
-		tree_values = []
-		self.recurse_node_properties(tree_root, root_height, tree_values)
-
-		tree_array = numpy.array(tree_values, node_struct_format)
-		tree_array.sort() # clades should be sorted to that topology hashes are consistent
-		self.tree_arrays.append(tree_array)
-
-	def recurse_node_properties(self, node, node_height, tree_values):
-		if not node.is_leaf():
-			child1, child2 = node.get_children() # assumes strictly bifurcating tree
-			child1_clade = set(child1.get_leaf_names())
-			child2_clade = set(child2.get_leaf_names())
-
-			child1_height = node_height - child1.dist
-			child2_height = node_height - child2.dist
-
-			self.recurse_node_properties(child1, child1_height, tree_values)
-			self.recurse_node_properties(child2, child2_height, tree_values)
-
-			parent_id, split_id = calculate_node_hashes(child1_clade, child2_clade, self.taxon_order)
-			tree_values.append((parent_id, split_id, node_height))
+		self.clade_hashes = []
+		self.clade_ids = {}
+		self.node_buffer = numpy.zeros(0, dtype = node_struct_format)
+		self.node_array = self.node_buffer
+		self.tree_offsets = numpy.zeros(1, dtype = numpy.int64)
+		# the number of nodes and sum of node heights of each clade ID, updated as rows are appended to the node
+		# array, so mean heights are available without reading the node array again
+		self.clade_height_counts = numpy.zeros(0, dtype = numpy.int64)
+		self.clade_height_sums = numpy.zeros(0, dtype = numpy.float64)
+		self.topology_newicks = {} # one representative newick string for each topology hash
+		self.topology_splits = {} # the split of each clade in the topology hash, in the same order
+		self.topology_counts = {}
+		self.cc_counts = {}
+		self.clade_sizes = {}
+		self.n_trees = 0
+
+		# the number of nodes and sum of node heights of each clade, only kept instead of the node array by
+		# samples merged from saved counts (see merge_counts)
+		self.height_counts = None
+		self.height_sums = None
+
+		# the sum of the heights of each taxon's leaf over all trees, in taxon order, so taxa sampled at different
+		# times (tip dates) keep their own heights in summary trees
+		self.leaf_height_sums = numpy.zeros(0, dtype = numpy.float64)
+
+		self.add_trees(newick_strings, calibration_taxon, calibration_date, n_jobs, chunk_size)
+
+	# adds more trees to the sample, and returns the set of clades whose conditional clade counts have changed
+	# newick_strings may be any iterable (including a generator from iterate_trees)
+	# the taxon order is taken from the first tree ever added, before any chunks are processed
+	# raises CalibrationTaxonError if the calibration taxon is not one of its taxa
+	# chunks are processed by worker_pool if one is given (so callers adding trees repeatedly can reuse one pool),
+	# otherwise by a pool of n_jobs workers created for this call when n_jobs > 1
+	def add_trees(self, newick_strings, calibration_taxon, calibration_date, n_jobs = 1, chunk_size = 1000, worker_pool = None):
+		changed_clades = set()
+
+		newick_iterator = iter(newick_strings)
+		first_newick = next(newick_iterator, None)
+		if first_newick is None:
+			return changed_clades
+
+		if len(self.taxon_order) == 0:
+			taxa = newick_taxon_names(first_newick)
+			self.taxon_order = sorted(taxa)
+			self.taxon_indices = calculate_taxon_indices(self.taxon_order)
+			self.leaf_height_sums = numpy.zeros(len(self.taxon_order), dtype = numpy.float64)
+
+		if calibration_taxon == "":
+			calibration_taxon = self.taxon_order[0]
+		elif calibration_taxon not in self.taxon_indices:
+			raise CalibrationTaxonError("not a taxon of the MCMC sample: " + calibration_taxon)
+
+		newick_iterator = itertools.chain([first_newick], newick_iterator)
+		chunk_arguments = ((chunk, self.taxon_order, calibration_taxon, calibration_date) for chunk in iterate_chunks(newick_iterator, chunk_size))
+
+		# chunks are processed independently (in worker processes when n_jobs > 1), and their partial counts
+		# are merged in the same order as the input file, so the result is identical to processing the sample serially
+		own_pool = None
+		if (worker_pool is None) and (n_jobs > 1):
+			own_pool = multiprocessing.Pool(n_jobs)
+			worker_pool = own_pool
+
+		try:
+			if worker_pool is not None:
+				chunk_results = ordered_pool_map(worker_pool, process_sample_chunk, chunk_arguments, max(n_jobs, 1) * 2)
+			else:
+				chunk_results = (process_sample_chunk(arguments) for arguments in chunk_arguments)
+
+			for chunk_result in chunk_results:
+				chunk_clades, chunk_nodes, topology_newicks, topology_splits, topology_counts, cc_counts, clade_sizes, leaf_height_sums = chunk_result
+				changed_clades.update(cc_counts)
+				self.append_nodes(self.merge_chunk(chunk_result))
+		finally: # every task has finished unless a worker failed, so workers are never stopped mid-task
+			if own_pool is not None:
+				own_pool.terminate()
+				own_pool.join()
+
+		# every tree is strictly bifurcating, so every tree has the same number of internal nodes
+		n_nodes = len(self.taxon_order) - 1
+		self.tree_offsets = numpy.arange(self.n_trees + 1, dtype = numpy.int64) * n_nodes
+
+		return changed_clades
+
+	# appends rows to the node array, and adds their heights to the height accumulators of their clades. when
+	# node_buffer is full it is replaced by one of twice the size, so each row is only copied a constant number of
+	# times on average, however many small batches of trees are added
+	def append_nodes(self, node_array):
+		n_filled = len(self.node_array)
+		n_rows = n_filled + len(node_array)
+		if n_rows > len(self.node_buffer):
+			node_buffer = numpy.empty(max(n_rows, 2 * len(self.node_buffer)), dtype = node_struct_format)
+			node_buffer[:n_filled] = self.node_array
+			self.node_buffer = node_buffer
+
+		self.node_buffer[n_filled:n_rows] = node_array
+		self.node_array = self.node_buffer[:n_rows]
+
+		n_clades = len(self.clade_hashes)
+		n_new_clades = n_clades - len(self.clade_height_counts)
+		self.clade_height_counts = numpy.concatenate([self.clade_height_counts, numpy.zeros(n_new_clades, dtype = numpy.int64)])
+		self.clade_height_sums = numpy.concatenate([self.clade_height_sums, numpy.zeros(n_new_clades, dtype = numpy.float64)])
+		self.clade_height_counts += numpy.bincount(node_array["f0"], minlength = n_clades)
+		self.clade_height_sums += numpy.bincount(node_array["f0"], weights = node_array["f2"], minlength = n_clades)
+
+	# translates the chunk's own clade IDs into sample clade IDs, and returns the translated node array
+	def merge_chunk(self, chunk_result):
+		chunk_clades, node_array, topology_newicks, topology_splits, topology_counts, cc_counts, clade_sizes, leaf_height_sums = chunk_result
+
+		chunk_clade_ids = numpy.zeros(len(chunk_clades), dtype = numpy.int32)
+		for i in range(len(chunk_clades)):
+			clade_hash = chunk_clades[i]
+			if clade_hash not in self.clade_ids:
+				self.clade_ids[clade_hash] = len(self.clade_hashes)
+				self.clade_hashes.append(clade_hash)
+
+			chunk_clade_ids[i] = self.clade_ids[clade_hash]
+
+		node_array["f0"] = chunk_clade_ids[node_array["f0"]]
+		node_array["f1"] = chunk_clade_ids[node_array["f1"]]
+		self.n_trees += len(node_array) // (len(self.taxon_order) - 1)
+		self.leaf_height_sums += leaf_height_sums
+
+		self.merge_count_dicts(topology_newicks, topology_splits, topology_counts, cc_counts, clade_sizes)
+
+		return node_array
+
+	# adds topology, conditional clade and clade counts to the counts of this sample
+	def merge_count_dicts(self, topology_newicks, topology_splits, topology_counts, cc_counts, clade_sizes):
+		for topology_hash, topology_count in topology_counts.items():
+			if topology_hash in self.topology_counts:
+				self.topology_counts[topology_hash] += topology_count
+			else: # first time this topology has been seen, so the new counts have the representative newick string
+				self.topology_counts[topology_hash] = topology_count
+				self.topology_newicks[topology_hash] = topology_newicks[topology_hash]
+				self.topology_splits[topology_hash] = topology_splits[topology_hash]
+
+		for parent_hash, split_counts in cc_counts.items():
+			if parent_hash not in self.cc_counts:
+				self.cc_counts[parent_hash] = dict(split_counts)
+			else:
+				parent_counts = self.cc_counts[parent_hash]
+				for split_hash, split_count in split_counts.items():
+					if split_hash in parent_counts:
+						parent_counts[split_hash] += split_count
+					else:
+						parent_counts[split_hash] = split_count
+
+		self.clade_sizes.update(clade_sizes)
+
+	# adds the counts of another sample of the same taxa to this sample. the node array of this sample is
+	# discarded, and replaced by the number of nodes and sum of node heights of each clade of both samples
+	def merge_counts(self, other_sample):
+		if len(self.taxon_order) == 0:
+			self.taxon_order = list(other_sample.taxon_order)
+			self.taxon_indices = calculate_taxon_indices(self.taxon_order)
+			self.leaf_height_sums = numpy.zeros(len(self.taxon_order), dtype = numpy.float64)
+		elif other_sample.taxon_order != self.taxon_order:
+			raise ValueError("Samples with different taxa cannot be merged")
+
+		height_counts, height_sums = self.calculate_height_accumulators()
+		other_counts, other_sums = other_sample.calculate_height_accumulators()
+		for clade_hash in other_counts:
+			height_counts[clade_hash] = height_counts.get(clade_hash, 0) + other_counts[clade_hash]
+			height_sums[clade_hash] = height_sums.get(clade_hash, 0.0) + other_sums[clade_hash]
+
+		for clade_hash in other_sample.clade_hashes:
+			if clade_hash not in self.clade_ids:
+				self.clade_ids[clade_hash] = len(self.clade_hashes)
+				self.clade_hashes.append(clade_hash)
+
+		self.merge_count_dicts(other_sample.topology_newicks, other_sample.topology_splits, other_sample.topology_counts, other_sample.cc_counts, other_sample.clade_sizes)
+		self.n_trees += other_sample.n_trees
+		self.leaf_height_sums = self.leaf_height_sums + other_sample.leaf_height_sums
+
+		self.node_buffer = numpy.zeros(0, dtype = node_struct_format)
+		self.node_array = self.node_buffer
+		self.tree_offsets = numpy.zeros(1, dtype = numpy.int64)
+		self.clade_height_counts = numpy.zeros(0, dtype = numpy.int64)
+		self.clade_height_sums = numpy.zeros(0, dtype = numpy.float64)
+		self.height_counts = height_counts
+		self.height_sums = height_sums
+
+	# returns dictionaries of the number of nodes and the sum of node heights of each clade, from the height
+	# accumulators of each clade ID unless they are already kept as dictionaries
+	def calculate_height_accumulators(self):
+		if self.height_counts is not None:
+			return dict(self.height_counts), dict(self.height_sums)
+
+		height_counts = {}
+		height_sums = {}
+		for clade_id in numpy.flatnonzero(self.clade_height_counts).tolist():
+			clade_hash = self.clade_hashes[clade_id]
+			height_counts[clade_hash] = int(self.clade_height_counts[clade_id])
+			height_sums[clade_hash] = float(self.clade_height_sums[clade_id])
+
+		return height_counts, height_sums
+
+	# returns a dictionary of the mean height of each taxon's leaf, keyed by taxon name
+	def calculate_leaf_heights(self):
+		leaf_heights = {}
+		for taxon_index in range(len(self.taxon_order)):
+			leaf_heights[self.taxon_order[taxon_index]] = self.leaf_height_sums[taxon_index] / self.n_trees
+
+		return leaf_heights
 
 class DiscreteProbabilities():
 	def __init__(self, data):
 		sorted_hashes = sorted(data.keys())
 		self.n_features = len(sorted_hashes)
-		self.hashes_array = numpy.array(sorted_hashes)
+		self.hashes_array = numpy.empty(self.n_features, dtype = object) # hashes may be integers or tuples of integers
+		for i in range(self.n_features):
+			self.hashes_array[i] = sorted_hashes[i]
 
 		sorted_data = [data[feature_hash] for feature_hash in self.hashes_array]
 		self.data_array = numpy.array(sorted_data)
@@ -124,8 +325,7 @@ class DiscreteProbabilities():
 		self.convert_probabilities()
 
 	def add_probabilities(self, probabilities):
-		for feature in self.hashes_array:
-			feature_hash = feature.tostring()
+		for feature_hash in self.hashes_array:
 			self.probabilities[feature_hash] = probabilities[feature_hash]
 
 		self.convert_probabilities()
@@ -134,8 +334,9 @@ class DiscreteProbabilities():
 		log_counts = {}
 		all_log_counts = []
 
-		for count_hash, count in counts.items():
-			log_count = math.log(count)
+		# sum in hash order, so the result does not depend on the order in which counts were accumulated
+		for count_hash in sorted(counts):
+			log_count = math.log(counts[count_hash])
 			log_counts[count_hash] = log_count
 			all_log_counts.append(log_count)
 
@@ -167,7 +368,7 @@ class DiscreteProbabilities():
 		cull_indices = []
 		for i in topology_descending_order:
 			if (posterior_features >= max_features) or (posterior_probability >= max_probability):
-				cull_hash = self.hashes_array[i].tostring()
+				cull_hash = self.hashes_array[i]
 				self.probabilities.pop(cull_hash)
 				cull_indices.append(i)
 
@@ -180,441 +381,2067 @@ class DiscreteProbabilities():
 
 		self.n_features = len(self.probabilities_array)
 
+		return cull_indices
+
+# the clades of each topology are already encoded in its hash, and topology_splits has the split of each
+# of those clades in the same order, so the topologies never need to be parsed again
 class TopologyProbabilities(DiscreteProbabilities):
-	def probabilities_from_ccs(self, cc_sets):
-		topology_sample = TopologySample(self.data_array)
+	def __init__(self, data, topology_splits):
+		DiscreteProbabilities.__init__(self, data)
 
+		self.splits_array = numpy.empty(self.n_features, dtype = object)
 		for i in range(self.n_features):
-			topology_array = topology_sample.topology_arrays[i]
-			topology_hash = self.hashes_array[i]
-			node_probabilities = []
-			for node in topology_array:
-				parent_hash = node[0].tostring() # the hash for the clade
-				split_hash = node[1].tostring() # the hash for the bifurcation
+			self.splits_array[i] = topology_splits[self.hashes_array[i]]
+
+	def cull_probabilities(self, max_features, max_probability):
+		cull_indices = DiscreteProbabilities.cull_probabilities(self, max_features, max_probability)
+		self.splits_array = numpy.delete(self.splits_array, cull_indices)
+
+		return cull_indices
 
-				n_node_taxa = clade_size(parent_hash)
-				if n_node_taxa >= 3: # conditional clade
-					split_probability = cc_sets[parent_hash].probabilities[split_hash]
-					node_probabilities.append(split_probability)
+	# the probability of each topology is the product of the probabilities of its conditional clades, so
+	# the log probabilities of every conditional clade of every topology are gathered and summed at once
+	def probabilities_from_ccs(self, cc_set):
+		if self.n_features == 0:
+			return
 
-			topology_probability = numpy.prod(node_probabilities)
-			self.probabilities[topology_hash] = topology_probability
+		clade_ids = cc_set.clade_ids
+		parent_ids = numpy.array([clade_ids[parent_hash] for parent_hash in itertools.chain.from_iterable(self.hashes_array)], dtype = numpy.int64)
+		split_hashes = list(itertools.chain.from_iterable(self.splits_array))
+		topology_indices = numpy.repeat(numpy.arange(self.n_features), len(self.hashes_array[0]))
+
+		# single taxa and cherries can only be resolved one way, so only clades of three or more taxa count
+		cc_nodes = numpy.flatnonzero(cc_set.clade_sizes[parent_ids] >= 3)
+		child1_ids = numpy.array([clade_ids[split_hashes[i]] for i in cc_nodes.tolist()], dtype = numpy.int64)
+		cc_indices = cc_set.split_indices(parent_ids[cc_nodes], child1_ids)
+
+		with numpy.errstate(divide = "ignore"):
+			log_split_probabilities = numpy.log(cc_set.split_probabilities[cc_indices])
+
+		log_topology_probabilities = numpy.bincount(topology_indices[cc_nodes], weights = log_split_probabilities, minlength = self.n_features)
+		topology_probabilities = numpy.exp(log_topology_probabilities)
+
+		for i in range(self.n_features):
+			self.probabilities[self.hashes_array[i]] = float(topology_probabilities[i])
 
 		self.convert_probabilities()
 
 	def add_clade_support(self, clade_set, taxon_order):
-		topologies_with_support = []
-		for topology_newick in self.data_array:
-			root_node = ete2.Tree(topology_newick)
-			for node in root_node.get_descendants():
-				if not node.is_leaf():
-					child1, child2 = node.get_children()
-					child1_clade = set(child1.get_leaf_names())
-					child2_clade = set(child2.get_leaf_names())
+		taxon_indices = calculate_taxon_indices(taxon_order)
+		clade_probabilities = clade_set.probabilities
 
-					clade_hash, split_hash = calculate_node_hashes(child1_clade, child2_clade, taxon_order)
-					clade_hash = clade_hash.rstrip("\x00")
-					split_hash = clade_hash.rstrip("\x00")
+		topologies_with_support = [newick_with_support(topology_newick, clade_probabilities, taxon_indices) for topology_newick in self.data_array]
 
-					clade_probability = clade_set.probabilities[clade_hash]
-					node.support = clade_probability
+		self.data_array = numpy.array(topologies_with_support)
 
-			newick_with_support = root_node.write(format = 2)
-			topologies_with_support.append(newick_with_support)
+	# replaces every branch length with the difference between the summarized heights of a node and its parent
+	# a node is never placed above its parent, so clades whose height is not in clade_heights (because they were
+	# never sampled) or whose summarized height is lower than a child's are placed at their highest child
+	# each leaf is placed at the height of its taxon in leaf_heights (keyed by taxon name), so tip dates are kept
+	def add_consensus_heights(self, clade_heights, taxon_order, leaf_heights):
+		taxon_indices = calculate_taxon_indices(taxon_order)
 
-		self.data_array = numpy.array(topologies_with_support)
+		topologies_with_heights = [newick_with_heights(topology_newick, clade_heights, taxon_indices, leaf_heights) for topology_newick in self.data_array]
 
-	def add_consensus_heights(self):
-		pass
+		self.data_array = numpy.array(topologies_with_heights)
 
 class CladeProbabilities(DiscreteProbabilities):
-	def derive_clade_probabilities(self, cc_sets, n_taxa):
-		reverse_ccp = reverse_cc_probabilities(cc_sets)
-		root_hash = calculate_root_hash(n_taxa)
-		self.probabilities[root_hash] = 1.0
+	def derive_clade_probabilities(self, cc_set, n_taxa):
+		# there may be multiple paths from any clade to the root, so the sum of path probabilities is required
+		# as clades can only be children of larger parents, by calculating probabilities of larger clades first,
+		# the conditional probability of the clade of interest may be multiplied by the parent clade probability
+		# which is the sum of path probabilities from the parent to the root
+		cc_set.build_reverse_index()
+		clade_probabilities = numpy.zeros(cc_set.n_clades, dtype = numpy.float64)
+		clade_probabilities[cc_set.root_id] = 1.0
+
+		# every clade of one size only has parents of larger sizes, so the probabilities of one size level are
+		# a single sparse matrix-vector product of the reverse index and the probabilities of larger clades
+		for level_size in range(n_taxa - 1, 0, -1):
+			level_start = cc_set.level_offsets[level_size]
+			level_end = cc_set.level_offsets[level_size + 1]
+			if level_start == level_end:
+				continue
+
+			reverse_start = cc_set.reverse_offsets[level_start]
+			reverse_end = cc_set.reverse_offsets[level_end]
+			level_splits = cc_set.reverse_splits[reverse_start:reverse_end]
+			level_parents = cc_set.reverse_parents[reverse_start:reverse_end]
+
+			# the product of conditional clade probabilities which link a clade to the root of the tree
+			path_probabilities = cc_set.split_probabilities[level_splits] * clade_probabilities[level_parents]
+			level_children = numpy.repeat(numpy.arange(level_end - level_start), numpy.diff(cc_set.reverse_offsets[level_start:level_end + 1]))
+			clade_probabilities[level_start:level_end] = numpy.bincount(level_children, weights = path_probabilities, minlength = level_end - level_start)
+
+		for clade_hash in self.hashes_array:
+			self.probabilities[clade_hash] = clade_probabilities[cc_set.clade_ids[clade_hash]]
+
+		self.convert_probabilities()
+
+	# the probability of each clade is the sum of the probabilities of the topologies that contain it
+	# the clades of every topology are concatenated and summed with one weighted bincount, which adds
+	# the topology probabilities in the same order as summing them topology by topology
+	def melt_clade_probabilities(self, topology_set, n_taxa):
+		if topology_set.n_features == 0:
+			return
+
+		clade_indices = {}
+		for i in range(self.n_features):
+			clade_indices[self.hashes_array[i]] = i
 
-		clades_by_size = []
-		for i in range(n_taxa - 1):
-			clades_by_size.append(set())
+		# topology hash is a tuple of sorted clade hashes, and every topology has the same number of clades
+		topology_clades = numpy.array([clade_indices[clade_hash] for clade_hash in itertools.chain.from_iterable(topology_set.hashes_array)], dtype = numpy.int64)
+		clade_weights = numpy.repeat(topology_set.probabilities_array, len(topology_set.hashes_array[0]))
+		melted_probabilities = numpy.bincount(topology_clades, weights = clade_weights, minlength = self.n_features)
 
 		for i in range(self.n_features):
-			clade_hash = self.hashes_array[i]
-			n_clade_taxa = self.data_array[i]
-			clades_by_size[n_taxa - n_clade_taxa].add(clade_hash)
-
-		# iterate through clades from largest to smallest (in number of taxa)
-		for i in range(1, n_taxa - 1): # skip the root hash
-			for clade_hash in clades_by_size[i]:
-				# there may be multiple paths from any clade to the root, so the sum of path probabilities is required
-				# as clades can only be children of larger parents, by calculating probabilities of larger clades first,
-				# the conditional probability of the clade of interest may be multiplied by the parent clade probability
-				# which is the sum of path probabilities from the parent to the root
-				clade_probability = 0.0
-				conditional_parents = reverse_ccp[clade_hash]
-				for parent_hash in conditional_parents:
-					# the product of conditional clade probabilities which link a clade to the root of the tree
-					path_probability = conditional_parents[parent_hash] * self.probabilities[parent_hash]
-					clade_probability += path_probability
-
-				self.probabilities[clade_hash] = clade_probability
+			self.probabilities[self.hashes_array[i]] += melted_probabilities[i]
 
 		self.convert_probabilities()
 
-	def melt_clade_probabilities(self, topology_set, n_taxa):
+# all conditional clades of a sample in one compact table. every clade (including single taxa) is interned
+# to a dense integer ID, ordered by clade size so children always have smaller IDs than their parents
+# the splits of each parent clade are stored contiguously (like a CSR sparse matrix), so the splits of
+# parent i are entries split_offsets[i] to split_offsets[i + 1] of the flat split arrays
+class ConditionalCladeProbabilities():
+	def __init__(self, cc_counts, n_taxa):
 		root_hash = calculate_root_hash(n_taxa)
-		n_bytes = len(root_hash) # maximum number of bytes required to store clade hashes
-		clade_dtype = "a" + str(n_bytes)
 
-		clade_probability_cache = {}
-		for i in range(topology_set.n_features):
-			topology_hash = topology_set.hashes_array[i]
-			topology_probability = topology_set.probabilities_array[i]
+		clade_hashes = set([root_hash])
+		for parent_hash, split_counts in cc_counts.items():
+			clade_hashes.add(parent_hash)
+			for split_hash in split_counts:
+				child1_hash, child2_hash = elucidate_cc_split(parent_hash, split_hash)
+				clade_hashes.add(child1_hash)
+				clade_hashes.add(child2_hash)
+
+		sorted_clades = sorted(clade_hashes, key = lambda clade_hash: (clade_size(clade_hash), clade_hash))
+		self.n_clades = len(sorted_clades)
+
+		self.clade_ids = {}
+		self.clade_hashes = numpy.empty(self.n_clades, dtype = object)
+		self.clade_sizes = numpy.zeros(self.n_clades, dtype = numpy.int32)
+		for i in range(self.n_clades):
+			clade_hash = sorted_clades[i]
+			self.clade_ids[clade_hash] = i
+			self.clade_hashes[i] = clade_hash
+			self.clade_sizes[i] = clade_size(clade_hash)
+
+		self.root_id = self.clade_ids[root_hash]
+
+		split_counts_list = []
+		split_child1_list = []
+		split_child2_list = []
+		self.split_offsets = numpy.zeros(self.n_clades + 1, dtype = numpy.int64)
+		for parent_id in range(self.n_clades):
+			parent_hash = self.clade_hashes[parent_id]
+			if parent_hash in cc_counts:
+				parent_splits = []
+				for split_hash, split_count in cc_counts[parent_hash].items():
+					child1_hash, child2_hash = elucidate_cc_split(parent_hash, split_hash)
+					parent_splits.append((self.clade_ids[child1_hash], self.clade_ids[child2_hash], split_count))
+
+				parent_splits.sort() # splits of each parent are ordered by first child, so they can be binary searched
+				for child1_id, child2_id, split_count in parent_splits:
+					split_child1_list.append(child1_id)
+					split_child2_list.append(child2_id)
+					split_counts_list.append(split_count)
+
+			self.split_offsets[parent_id + 1] = len(split_counts_list)
+
+		self.n_splits = len(split_counts_list)
+		self.split_child1 = numpy.array(split_child1_list, dtype = numpy.int64)
+		self.split_child2 = numpy.array(split_child2_list, dtype = numpy.int64)
+		self.split_counts = numpy.array(split_counts_list, dtype = numpy.float64)
+		self.split_parents = numpy.repeat(numpy.arange(self.n_clades), numpy.diff(self.split_offsets))
+		self.split_probabilities = numpy.zeros(self.n_splits, dtype = numpy.float64)
+
+		# the first clade ID of each clade size, so the clades of size s are IDs level_offsets[s] to level_offsets[s + 1]
+		self.level_offsets = numpy.searchsorted(self.clade_sizes, numpy.arange(n_taxa + 2)).astype(numpy.int64)
+
+		# child to parent index, built the first time it is needed by build_reverse_index
+		self.reverse_offsets = None
+		self.reverse_splits = None
+		self.reverse_parents = None
+
+	# the transpose of the split table, so the parents of child clade i are entries reverse_offsets[i] to
+	# reverse_offsets[i + 1] of reverse_parents, linked by the splits at the same entries of reverse_splits
+	# only the structure is indexed, so the index stays valid when split probabilities are recalculated
+	def build_reverse_index(self):
+		if self.reverse_offsets is not None:
+			return
+
+		split_children = numpy.concatenate((self.split_child1, self.split_child2))
+		split_indices = numpy.concatenate((numpy.arange(self.n_splits), numpy.arange(self.n_splits)))
+		child_order = numpy.argsort(split_children, kind = "mergesort")
+
+		self.reverse_offsets = numpy.zeros(self.n_clades + 1, dtype = numpy.int64)
+		self.reverse_offsets[1:] = numpy.cumsum(numpy.bincount(split_children, minlength = self.n_clades))
+		self.reverse_splits = split_indices[child_order]
+		self.reverse_parents = self.split_parents[self.reverse_splits]
+
+	# normalizes the split counts of every parent clade at once
+	def probabilities_from_counts(self):
+		parent_totals = numpy.bincount(self.split_parents, weights = self.split_counts, minlength = self.n_clades)
+		self.split_probabilities = self.split_counts / parent_totals[self.split_parents]
+
+	# updates the counts of the splits of the changed parent clades from cc_counts, and renormalizes only those
+	# parents. counts only ever grow, so when a parent has as many splits in cc_counts as in the table, they are
+	# the same splits. returns the IDs of the updated parents, or None when cc_counts has a clade or split which
+	# is not in the table, as then the table has to be rebuilt
+	def update_counts(self, cc_counts, changed_clades):
+		changed_ids = []
+		for parent_hash in changed_clades:
+			if parent_hash not in self.clade_ids:
+				return None
+
+			parent_id = self.clade_ids[parent_hash]
+			split_start = self.split_offsets[parent_id]
+			split_end = self.split_offsets[parent_id + 1]
+			parent_counts = cc_counts[parent_hash]
+			if len(parent_counts) != split_end - split_start:
+				return None
+
+			changed_ids.append(parent_id)
+
+		changed_ids.sort()
+		for parent_id in changed_ids:
+			split_start = self.split_offsets[parent_id]
+			split_end = self.split_offsets[parent_id + 1]
+			parent_counts = cc_counts[self.clade_hashes[parent_id]]
+			for j in range(split_start, split_end):
+				self.split_counts[j] = parent_counts[self.clade_hashes[self.split_child1[j]]]
+
+			split_counts = self.split_counts[split_start:split_end]
+			self.split_probabilities[split_start:split_end] = split_counts / split_counts.sum()
+
+		return changed_ids
+
+	# splits are ordered by parent then by first child, so combining the two IDs into one integer key gives
+	# a sorted array, and the indices of many splits can be found with a single binary search
+	def split_indices(self, parent_ids, child1_ids):
+		split_keys = self.split_parents * self.n_clades + self.split_child1
+
+		return numpy.searchsorted(split_keys, parent_ids * self.n_clades + child1_ids)
+
+# summarizes one sample, calculating each stage only when an output first needs it, and only once
+# probability_method defaults to "conditional-clade" for derived candidates and to "tree-topology" for sampled
+# candidates. a conditional clade table whose probabilities are already calculated may be passed as cc_set,
+# along with the derivations already found from it as topology_derivations, so they are not recalculated
+# stage_callback, if given, is called with a message and a name before each stage is calculated
+class Summarizer():
+	def __init__(self, sample, candidate_method = "derived", derivation_method = "k-best", probability_method = None, support_method = None, node_heights = None, exact_heights = False, max_topologies = 1, max_probability = 1.0, prune_frontier = False, cc_set = None, topology_derivations = None, stage_callback = None):
+		if probability_method is None:
+			if candidate_method == "derived":
+				probability_method = "conditional-clade"
+			else:
+				probability_method = "tree-topology"
+
+		self.sample = sample
+		self.taxon_order = sample.taxon_order
+		self.n_taxa = len(sample.taxon_order)
+		self.n_unique_topologies = len(sample.topology_counts)
+
+		self.candidate_method = candidate_method
+		self.derivation_method = derivation_method
+		self.probability_method = probability_method
+		self.support_method = support_method
+		self.node_heights = node_heights
+		self.exact_heights = exact_heights
+		self.max_topologies = max_topologies
+		self.max_probability = max_probability
+		self.prune_frontier = prune_frontier
+		self.stage_callback = stage_callback
+
+		self.cc_set = cc_set
+		self.topology_derivations = topology_derivations
+		self.sampled_topology_set = None
+		self.clade_sets = {}
+		self.output_topology_set = None
+		self.frontier_telemetry = None
+		self.statistics = None
+
+	def start_stage(self, stage_message, stage_name):
+		if self.stage_callback is not None:
+			self.stage_callback(stage_message, stage_name)
+
+	# every topology in the sample, with probabilities from their frequencies
+	def sampled_topologies(self):
+		if self.sampled_topology_set is None:
+			self.start_stage("Calculating topology probabilities from MCMC sample...", "sampled_topologies")
+			self.sampled_topology_set = TopologyProbabilities(self.sample.topology_newicks, self.sample.topology_splits)
+			self.sampled_topology_set.probabilities_from_counts(self.sample.topology_counts)
+
+		return self.sampled_topology_set
+
+	def conditional_clades(self):
+		if self.cc_set is None:
+			self.start_stage("Counting conditional clades...", "counting")
+			cc_set = ConditionalCladeProbabilities(self.sample.cc_counts, self.n_taxa)
+			self.start_stage("Calculating conditional clade probabilities...", "cc_probabilities")
+			cc_set.probabilities_from_counts()
+			self.cc_set = cc_set
+
+		return self.cc_set
+
+	# method is "conditional-clade" or "tree-topology", and defaults to the support method
+	def clade_probabilities(self, method = None):
+		if method is None:
+			method = self.support_method
+
+		if method not in self.clade_sets:
+			clade_set = CladeProbabilities(self.sample.clade_sizes)
+			if method == "conditional-clade":
+				cc_set = self.conditional_clades()
+				self.start_stage("Calculating clade probabilities from conditional clade probabilities...", "clade_probabilities")
+				clade_set.derive_clade_probabilities(cc_set, self.n_taxa)
+			else:
+				topology_set = self.sampled_topologies()
+				self.start_stage("Calculating clade probabilities from MCMC sample...", "clade_probabilities")
+				clade_set.melt_clade_probabilities(topology_set, self.n_taxa)
 
-			topology_char_array = numpy.array(list(topology_hash))
-			clades_array = topology_char_array.view(clade_dtype)
-			for clade_hash in clades_array:
-				self.probabilities[clade_hash] += topology_probability
+			self.clade_sets[method] = clade_set
 
-		self.convert_probabilities()
+		return self.clade_sets[method]
 
-# read a nexus or newick format file containing phylogenetic trees
-# if the file does not begin with a nexus header, assumes it is a newick file
-# returns a list of newick strings, in the same order as the input file
-def trees_from_path(trees_filepath):
-	nexus_header = "#NEXUS"
+	def ccd_statistics(self):
+		if self.statistics is None:
+			cc_set = self.conditional_clades()
+			self.start_stage("Calculating conditional clade distribution statistics...", "ccd_statistics")
+			self.statistics = ccd_statistics(cc_set)
+
+		return self.statistics
 
-	trees_file = open(trees_filepath)
-	first_line = trees_file.readline().strip().upper()
-	trees_file.seek(0)
+	# the credible set of topologies, with their probabilities and any support values and node heights
+	def output_topologies(self):
+		if self.output_topology_set is not None:
+			return self.output_topology_set
 
-	if first_line == nexus_header: # looks like a nexus file, convert to newick
-		trees_list = dendropy.TreeList.get_from_stream(trees_file, schema = "nexus")
-		trees_file.close()
+		if self.candidate_method == "derived": # derive credible topologies from conditional clades
+			cc_set = self.conditional_clades()
+			self.start_stage("Deriving probable topologies from conditional clades...", "deriving")
+			if self.derivation_method == "k-best":
+				output_topology_set = derive_kbest_topologies(cc_set, self.taxon_order, self.max_topologies, self.max_probability, self.topology_derivations)
+			else:
+				self.frontier_telemetry = []
+				output_topology_set = derive_best_topologies(cc_set, self.taxon_order, self.max_topologies, self.max_probability, self.prune_frontier, self.frontier_telemetry)
+		else: # base credible topologies on frequency in MCMC sample
+			# a separate set from sampled_topologies, which is kept whole for tree-topology clade probabilities
+			output_topology_set = TopologyProbabilities(self.sample.topology_newicks, self.sample.topology_splits)
+
+		if self.probability_method == "conditional-clade":
+			cc_set = self.conditional_clades()
+			self.start_stage("Calculating topology probabilities from conditional clade probabilities...", "topology_probabilities")
+			output_topology_set.probabilities_from_ccs(cc_set)
+		else:
+			self.start_stage("Calculating topology probabilities...", "topology_probabilities")
+			output_topology_set.probabilities_from_counts(self.sample.topology_counts)
+
+		# once probabilities have been calculated for each topology in the sampled set
+		# then topologies that exceed maximum topology/probability limits can be removed
+		if self.candidate_method == "sampled":
+			self.start_stage("Limiting output topologies to credible set...", "culling")
+			output_topology_set.cull_probabilities(self.max_topologies, self.max_probability)
+
+		if self.support_method is not None:
+			clade_set = self.clade_probabilities(self.support_method)
+			self.start_stage("Adding clade support values to tree topologies...", "support_values")
+			output_topology_set.add_clade_support(clade_set, self.taxon_order)
+
+		if self.node_heights is not None:
+			self.start_stage("Calculating node heights...", "node_heights")
+			output_clades = set()
+			for topology_hash in output_topology_set.hashes_array:
+				output_clades.update(topology_hash)
+
+			clade_heights = calculate_clade_heights(self.sample, output_clades, self.node_heights, self.exact_heights)
+			output_topology_set.add_consensus_heights(clade_heights, self.taxon_order, self.sample.calculate_leaf_heights())
+
+		self.output_topology_set = output_topology_set
+
+		return self.output_topology_set
+
+	# whole-sample statistics, including those of the conditional clade distribution for derived candidates
+	def write_info(self, info_file):
+		info_file.write("Number of taxa in each tree: %i\n" % (self.n_taxa))
+		info_file.write("Number of unique tree topologies in MCMC sample: %i\n" % (self.n_unique_topologies))
+
+		if self.candidate_method == "derived": # calculate summary statistics for topologies
+			statistics = self.ccd_statistics()
+			info_file.write("Number of topologies derived from conditional clades: %i\n" % (statistics["n_topologies"]))
+			info_file.write("Number of topologies derived from conditional clades (with non-zero probabilities): %i\n" % (statistics["n_nonzero_topologies"]))
+			info_file.write("Entropy of conditional clade distribution (nats): %f\n" % (statistics["entropy"]))
+			info_file.write("Probability of most probable derived topology: %g\n" % (statistics["map_probability"]))
+			info_file.write("Log probability of all derived topologies: %g\n" % (statistics["log_total_mass"]))
+
+	# the probability of each output topology, numbered in the same order as the output topologies
+	def write_csv(self, csv_file):
+		output_topology_set = self.output_topologies()
+		csv_writer = csv.writer(csv_file)
+
+		header_row = ["topology", "probability"]
+		csv_writer.writerow(header_row)
+
+		for i in range(output_topology_set.n_features):
+			topology_probability = output_topology_set.probabilities_array[i]
+			output_row = [i, topology_probability]
+			csv_writer.writerow(output_row)
+
+	# all output topologies in one newick (one tree per line) or nexus file, in the same order as the CSV file
+	# the probability of each topology is written in a comment before it, or with "name" in nexus files, in the
+	# name of the tree. lines are built in memory and written at once
+	def write_trees(self, trees_file, file_format = "newick", probability_annotation = "comment"):
+		output_topology_set = self.output_topologies()
+
+		tree_lines = []
+		if file_format == "nexus":
+			tree_lines.append("#NEXUS\n\nbegin taxa;\n\tdimensions ntax=%i;\n\ttaxlabels\n" % (self.n_taxa))
+			tree_lines.extend(["\t\t%s\n" % (newick_quote(taxon_name)) for taxon_name in self.taxon_order])
+			tree_lines.append("\t;\nend;\n\nbegin trees;\n")
+
+		for i in range(output_topology_set.n_features):
+			newick_string = output_topology_set.data_array[i]
+			topology_probability = float(output_topology_set.probabilities_array[i])
+			if file_format == "newick":
+				tree_lines.append("[&probability=%r] %s\n" % (topology_probability, newick_string))
+			elif probability_annotation == "name":
+				tree_lines.append("\ttree 'topology_%i_probability_%r' = [&R] %s\n" % (i, topology_probability, newick_string))
+			else:
+				tree_lines.append("\ttree topology_%i = [&R] [&probability=%r] %s\n" % (i, topology_probability, newick_string))
 
-		newick_blob = trees_list.as_string("newick", suppress_rooting = True)
-	else: # assume file is already in newick format
-		newick_blob = trees_file.read()
-		trees_file.close()
+		if file_format == "nexus":
+			tree_lines.append("end;\n")
 
-	newick_strings = newick_blob.strip().split("\n")
+		trees_file.writelines(tree_lines)
+
+	# the sizes of the sample and of whatever has been calculated from it so far
+	def cardinalities(self):
+		sizes = {"n_taxa": self.n_taxa, "n_trees": self.sample.n_trees, "n_unique_topologies": self.n_unique_topologies}
+		if self.cc_set is not None:
+			sizes["n_clades"] = self.cc_set.n_clades
+			sizes["n_conditional_clades"] = self.cc_set.n_splits
+		if self.output_topology_set is not None:
+			sizes["n_output_topologies"] = self.output_topology_set.n_features
+
+		return sizes
+
+# read a nexus or newick format file containing phylogenetic trees
+# if the file does not begin with a nexus header, assumes it is a newick file
+# returns a list of newick strings, in the same order as the input file
+def trees_from_path(trees_filepath):
+	newick_strings = list(iterate_trees(trees_filepath))
 	return newick_strings
 
-def calculate_node_hashes(children_a, children_b, taxon_order):
-	n_taxa = len(taxon_order)
-	children = set.union(children_a, children_b)
+# returns "gzip", "bzip2" or "xz" if a file is compressed, identified by its first bytes or else its suffix
+def compression_format(trees_filepath):
+	trees_file = open(trees_filepath, "rb")
+	magic_bytes = trees_file.read(6)
+	trees_file.close()
+
+	for compression, magic in compression_magic_bytes.items():
+		if magic_bytes.startswith(magic):
+			return compression
+
+	for suffix, compression in compression_suffixes.items():
+		if trees_filepath.endswith(suffix):
+			return compression
+
+	return None
+
+# the path of a file without any compression suffix
+def uncompressed_path(trees_filepath):
+	for suffix in compression_suffixes:
+		if trees_filepath.endswith(suffix):
+			return trees_filepath[:-len(suffix)]
+
+	return trees_filepath
+
+# opens a possibly compressed file for reading lines, decompressing it as it is read. gzip and bzip2 files are
+# decompressed in-process unless decompress_process is True, when the gzip or bzip2 program decompresses them in
+# a separate process, overlapping with reading trees. python 2 cannot decompress xz, so the xz program always is
+def open_trees_file(trees_filepath, decompress_process = False):
+	compression = compression_format(trees_filepath)
+
+	if compression is None:
+		return open(trees_filepath)
+	elif decompress_process or compression == "xz":
+		return DecompressionPipe(trees_filepath, compression)
+	elif compression == "gzip":
+		return io.BufferedReader(gzip.GzipFile(trees_filepath, "rb"), decompression_buffer_size)
+	else:
+		return bz2.BZ2File(trees_filepath, "rb", decompression_buffer_size)
+
+# the output of a decompression program, read like a file. if the program fails (because the file is corrupt
+# or truncated), IOError is raised when the pipe is closed
+class DecompressionPipe():
+	def __init__(self, trees_filepath, compression):
+		self.trees_filepath = trees_filepath
+		try:
+			self.process = subprocess.Popen([compression, "-dc", trees_filepath], stdout = subprocess.PIPE, bufsize = decompression_buffer_size)
+		except OSError as process_error:
+			raise IOError("Could not run %s to decompress %s: %s" % (compression, trees_filepath, process_error))
+
+		self.compression = compression
+
+	def __iter__(self):
+		return iter(self.process.stdout)
+
+	def readline(self):
+		return self.process.stdout.readline()
+
+	def read(self, size = -1):
+		return self.process.stdout.read(size)
+
+	def close(self):
+		self.process.stdout.close()
+		return_code = self.process.wait()
+		if return_code > 0: # a negative return code is the program being stopped after the pipe was closed early
+			raise IOError("%s could not decompress %s (exit status %i)" % (self.compression, self.trees_filepath, return_code))
+
+# reads the trees of nexus TREES blocks from text fed to it in pieces of any size, such as lines of a file or
+# text appended to a file by a running chain. statements end at semicolons outside of quotes and (possibly
+# nested) comments, and only complete statements are read. taxon names are translated using the TRANSLATE
+# table of the trees block, or if there is none, numbers are translated using the TAXLABELS of the taxa block
+class NexusTreesReader():
+	def __init__(self):
+		self.statement_parts = []
+		self.in_quote = False
+		self.comment_depth = 0
+		self.block_name = None
+		self.translate_table = {}
+		self.taxon_labels = []
+		self.taxon_label_set = set()
+
+	# returns the body of each tree statement completed by the text, to be converted by newick_string
+	# bodies are returned untranslated, so trees discarded as burn-in are never converted
+	def feed(self, text):
+		tree_bodies = []
+
+		text_start = 0
+		for delimiter_match in nexus_delimiter_regex.finditer(text):
+			delimiter = delimiter_match.group()
+			if self.in_quote:
+				if delimiter == "'": # a doubled quote closes then reopens the quote
+					self.in_quote = False
+			elif self.comment_depth > 0:
+				if delimiter == "[":
+					self.comment_depth += 1
+				elif delimiter == "]":
+					self.comment_depth -= 1
+			elif delimiter == "'":
+				self.in_quote = True
+			elif delimiter == "[":
+				self.comment_depth = 1
+			elif delimiter == ";":
+				self.statement_parts.append(text[text_start:delimiter_match.start()])
+				text_start = delimiter_match.end()
+				tree_body = self.read_statement("".join(self.statement_parts))
+				self.statement_parts = []
+				if tree_body is not None:
+					tree_bodies.append(tree_body)
+
+		self.statement_parts.append(text[text_start:])
+
+		return tree_bodies
+
+	# updates the block and translation state, and returns the body of a tree statement or None
+	def read_statement(self, statement):
+		statement = strip_nexus_comments(statement)
+		command_match = nexus_command_regex.match(statement)
+		if command_match is None:
+			return None
+
+		command = command_match.group(1).upper()
+		arguments = statement[command_match.end():]
+
+		if command == "BEGIN":
+			self.block_name = arguments.strip().upper()
+			if self.block_name == "TREES":
+				self.translate_table = {}
+		elif command == "END" or command == "ENDBLOCK":
+			self.block_name = None
+		elif (self.block_name == "TAXA" or self.block_name == "DATA") and command == "TAXLABELS":
+			self.taxon_labels = [nexus_name(token) for token in nexus_word_regex.findall(arguments)]
+			self.taxon_label_set = set(self.taxon_labels)
+		elif self.block_name == "TREES" and command == "TRANSLATE":
+			translate_words = nexus_word_regex.findall(arguments)
+			translate_words.append(",")
+			pair_start = 0
+			for i in range(len(translate_words)):
+				if translate_words[i] == ",":
+					pair_words = translate_words[pair_start:i]
+					if len(pair_words) >= 2:
+						self.translate_table[nexus_name(pair_words[0])] = newick_quote(nexus_name(pair_words[1]))
+					pair_start = i + 1
+		elif self.block_name == "TREES" and (command == "TREE" or command == "UTREE"):
+			tree_match = nexus_tree_regex.match(arguments)
+			if tree_match is not None:
+				return tree_match.group(1)
+
+		return None
+
+	# converts a tree body to a newick string without comments or whitespace, with translated taxon names
+	def newick_string(self, tree_body):
+		compact_newick = strip_nexus_comments(tree_body, remove_whitespace = True) + ";"
+
+		if len(self.translate_table) > 0:
+			return newick_leaf_regex.sub(self.translate_leaf, compact_newick)
+		elif len(self.taxon_labels) > 0:
+			return newick_leaf_regex.sub(self.number_leaf, compact_newick)
+		else:
+			return compact_newick
 
-	parent_boolean = numpy.zeros(n_taxa, dtype=numpy.uint8)
-	split_boolean = numpy.zeros(n_taxa, dtype=numpy.uint8)
+	def translate_leaf(self, leaf_match):
+		leaf_token = leaf_match.group()
+		return self.translate_table.get(nexus_name(leaf_token), leaf_token)
 
-	i = 0
-	for j in range(n_taxa):
-		t = taxon_order[j]
-		if t in children:
-			parent_boolean[j] = 1
+	def number_leaf(self, leaf_match):
+		leaf_token = leaf_match.group()
+		if leaf_token.isdigit() and (1 <= int(leaf_token) <= len(self.taxon_labels)) and (leaf_token not in self.taxon_label_set):
+			return newick_quote(self.taxon_labels[int(leaf_token) - 1])
 
-			if i == 0:
-				if t in children_a:
-					a_first = True
-				else:
-					a_first = False
+		return leaf_token
 
-			if (t in children_b) ^ a_first: # first child always "True"
-				split_boolean[i] = 1
+# removes (possibly nested) comments from nexus text, and optionally whitespace, but never from within quotes
+def strip_nexus_comments(text, remove_whitespace = False):
+	if remove_whitespace:
+		strip_regex = nexus_strip_whitespace_regex
+	else:
+		strip_regex = nexus_strip_regex
+
+	while True: # nested comments are removed from the innermost outwards
+		stripped_text = strip_regex.sub(keep_nexus_quotes, text)
+		if (stripped_text == text) or ("[" not in stripped_text):
+			return stripped_text
+
+		text = stripped_text
+
+def keep_nexus_quotes(strip_match):
+	stripped = strip_match.group()
+	if stripped[0] == "'":
+		return stripped
+
+	return ""
+
+# the name of a nexus word, with any quotes removed
+def nexus_name(word):
+	if len(word) >= 2 and word[0] == "'" and word[-1] == "'":
+		return word[1:-1].replace("''", "'")
+
+	return word
+
+# quotes a name which cannot be written as a plain newick label
+def newick_quote(name):
+	if newick_unsafe_regex.search(name) is None:
+		return name
+
+	return "'" + name.replace("'", "''") + "'"
+
+# as for trees_from_path, but newick strings are yielded one at a time so the sample is never held in memory
+# the first burn_in trees are skipped without being built, then only every thinning-th tree is yielded
+# compressed files are decompressed as they are read, as described for open_trees_file
+def iterate_trees(trees_filepath, burn_in = 0, thinning = 1, decompress_process = False):
+	trees_file = open_trees_file(trees_filepath, decompress_process)
+	first_line = trees_file.readline()
+	trees_lines = itertools.chain([first_line], trees_file)
+
+	if first_line.strip().upper() == "#NEXUS": # looks like a nexus file, read the trees of its trees blocks
+		nexus_reader = NexusTreesReader()
+		tree_source = itertools.chain.from_iterable(itertools.imap(nexus_reader.feed, trees_lines))
+	else: # assume file is already in newick format, one tree per line
+		nexus_reader = None
+		tree_source = trees_lines
+
+	tree_index = -1
+	for tree in tree_source:
+		if nexus_reader is None:
+			if tree.isspace() or len(tree) == 0:
+				continue
+
+		tree_index += 1
+		if (tree_index < burn_in) or ((tree_index - burn_in) % thinning != 0):
+			continue
+
+		if nexus_reader is None:
+			newick_string = tree.strip()
+		else:
+			newick_string = nexus_reader.newick_string(tree)
+
+		yield newick_string
+
+	trees_file.close()
+
+# records the wall time, CPU time and peak memory use of each stage of a run, and any counts of interest
+# a stage lasts until the next stage is started. if cprofile_stages is True, every stage is also run under
+# cProfile (which slows it down), and the statistics of the stage with the longest wall time are kept
+class StageProfiler():
+	def __init__(self, cprofile_stages = False):
+		self.cprofile_stages = cprofile_stages
+		self.stages = []
+		self.cardinalities = {}
+		self.stage_name = None
+		self.stage_start = None
+		self.stage_profile = None
+		self.hottest_stage = None # (wall time, stage name, cProfile statistics) of the slowest stage so far
+
+	def start_stage(self, stage_name):
+		self.end_stage()
+
+		self.stage_name = stage_name
+		self.stage_start = (time.time(), os.times())
+		if self.cprofile_stages:
+			self.stage_profile = cProfile.Profile()
+			self.stage_profile.enable()
+
+	def end_stage(self):
+		if self.stage_name is None:
+			return
+
+		if self.cprofile_stages:
+			self.stage_profile.disable()
+
+		wall_start, times_start = self.stage_start
+		times_end = os.times()
+		wall_time = time.time() - wall_start
+		stage_record = {
+			"stage": self.stage_name,
+			"wall": wall_time,
+			"cpu": (times_end[0] + times_end[1]) - (times_start[0] + times_start[1]),
+			"children_cpu": (times_end[2] + times_end[3]) - (times_start[2] + times_start[3]), # worker processes
+			"peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			"children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+		}
+		self.stages.append(stage_record)
+
+		if self.cprofile_stages and ((self.hottest_stage is None) or (wall_time > self.hottest_stage[0])):
+			self.hottest_stage = (wall_time, self.stage_name, self.stage_profile)
+
+		self.stage_name = None
+
+	def record(self, name, value):
+		self.cardinalities[name] = value
+
+	# writes the stages and counts as JSON, and the cProfile statistics of the slowest stage to json_path + ".pstats"
+	def write_json(self, json_path):
+		profile = {
+			"stages": self.stages,
+			"cardinalities": self.cardinalities,
+			"total_wall": sum([stage_record["wall"] for stage_record in self.stages]),
+		}
+
+		if self.hottest_stage is not None:
+			pstats_path = json_path + ".pstats"
+			wall_time, stage_name, stage_profile = self.hottest_stage
+			stage_profile.dump_stats(pstats_path)
+			profile["cprofile_stage"] = stage_name
+			profile["cprofile_path"] = pstats_path
+
+		json_file = open(json_path, "w")
+		json.dump(profile, json_file, indent = 1, sort_keys = True)
+		json_file.write("\n")
+		json_file.close()
+
+# reads trees as they are appended to a newick file (one tree per line) or nexus file by a running MCMC chain
+# the file is read from where the last call stopped, and a tree is only read once it is complete
+# burn_in and thinning are applied to the position of each tree in the whole file
+class TreeFileFollower():
+	def __init__(self, trees_filepath, burn_in = 0, thinning = 1):
+		self.trees_filepath = trees_filepath
+		self.burn_in = burn_in
+		self.thinning = thinning
+		self.file_offset = 0
+		self.tree_index = -1
+		self.nexus_reader = None
+		self.file_format = None # decided once the first line of the file is complete
+		self.incomplete_text = "" # text read after the last complete line, until the rest of the line is read
+
+	# yields the newick strings of trees appended since the last call, reading follow_block_size bytes at a time
+	# so trees can be added to a sample while the rest of the appended text is still being read
+	def read_new_trees(self):
+		trees_file = open(self.trees_filepath)
+		trees_file.seek(self.file_offset)
+		try:
+			while True:
+				block_text = trees_file.read(follow_block_size)
+				if len(block_text) == 0:
+					break
+
+				self.file_offset += len(block_text)
+				appended_text = self.incomplete_text + block_text
+				complete_length = appended_text.rfind("\n") + 1
+				if self.file_format is None:
+					if complete_length == 0:
+						self.incomplete_text = appended_text
+						continue
+					elif appended_text.lstrip().upper().startswith("#NEXUS"):
+						self.file_format = "nexus"
+						self.nexus_reader = NexusTreesReader()
+					else:
+						self.file_format = "newick"
+
+				# the nexus reader keeps incomplete statements itself, so all appended text is read
+				if self.file_format == "nexus":
+					self.incomplete_text = ""
+					trees = self.nexus_reader.feed(appended_text)
+				else:
+					self.incomplete_text = appended_text[complete_length:]
+					trees = appended_text[:complete_length].splitlines()
+
+				for tree in trees:
+					if self.nexus_reader is None and (tree.isspace() or len(tree) == 0):
+						continue
+
+					self.tree_index += 1
+					if (self.tree_index < self.burn_in) or ((self.tree_index - self.burn_in) % self.thinning != 0):
+						continue
+
+					if self.nexus_reader is None:
+						yield tree.strip()
+					else:
+						yield self.nexus_reader.newick_string(tree)
+		finally:
+			trees_file.close()
+
+# writes named numpy arrays to a single binary file, preceded by a JSON header which records their layout
+# every array is stored raw and aligned, so it can be memory-mapped by read_array_file without being parsed
+def write_array_file(file_path, header, arrays):
+	array_layout = {}
+	data_size = 0
+	for array_name in sorted(arrays):
+		array = arrays[array_name]
+		if array.dtype.names is None:
+			array_format = array.dtype.str
+		else:
+			array_format = ",".join([array.dtype[field_name].str for field_name in array.dtype.names])
+
+		array_layout[array_name] = (array_format, array.shape, data_size)
+		data_size += -(-array.nbytes // array_file_alignment) * array_file_alignment
+
+	header = dict(header)
+	header["arrays"] = array_layout
+	header_json = json.dumps(header, sort_keys = True)
+	header_size = len(array_file_magic) + 8 + len(header_json)
+	data_start = -(-header_size // array_file_alignment) * array_file_alignment
+
+	array_file = open(file_path, "wb")
+	array_file.write(array_file_magic)
+	array_file.write(struct.pack("<Q", len(header_json)))
+	array_file.write(header_json)
+	for array_name in sorted(arrays):
+		array_format, array_shape, array_offset = array_layout[array_name]
+		array_file.seek(data_start + array_offset)
+		array_file.write(numpy.ascontiguousarray(arrays[array_name]).tostring())
+
+	array_file.truncate(data_start + data_size)
+	array_file.close()
+
+def read_array_file(file_path):
+	array_file = open(file_path, "rb")
+	magic = array_file.read(len(array_file_magic))
+	if magic != array_file_magic:
+		array_file.close()
+		raise ValueError("Not a SCCULS array file: " + file_path)
+
+	header_size = struct.unpack("<Q", array_file.read(8))[0]
+	header = json.loads(array_file.read(header_size))
+	array_file.close()
+
+	data_start = -(-(len(array_file_magic) + 8 + header_size) // array_file_alignment) * array_file_alignment
+
+	arrays = {}
+	for array_name, (array_format, array_shape, array_offset) in header.pop("arrays").items():
+		array_dtype = numpy.dtype(str(array_format))
+		array_shape = tuple(array_shape)
+		if numpy.prod(array_shape) == 0: # zero length arrays cannot be memory-mapped
+			arrays[array_name] = numpy.zeros(array_shape, dtype = array_dtype)
+		else:
+			arrays[array_name] = numpy.memmap(file_path, dtype = array_dtype, mode = "r", offset = data_start + array_offset, shape = array_shape)
+
+	return header, arrays
+
+# clade bitsets are stored as rows of big-endian bytes, as they may be wider than any numpy integer type
+def clades_to_bytes(clade_hashes, n_taxa):
+	n_bytes = max(1, -(-n_taxa // 8))
+	clade_hex = "".join(["%0*x" % (n_bytes * 2, clade_hash) for clade_hash in clade_hashes])
+	clade_bytes = numpy.frombuffer(binascii.unhexlify(clade_hex), dtype = numpy.uint8).reshape(len(clade_hashes), n_bytes)
+
+	return clade_bytes
+
+def clades_from_bytes(clade_bytes):
+	n_clades, n_bytes = clade_bytes.shape
+	clade_hex = binascii.hexlify(clade_bytes.tostring())
+	hex_width = n_bytes * 2
+	clade_hashes = [int(clade_hex[i:i + hex_width], 16) for i in range(0, n_clades * hex_width, hex_width)]
+
+	return clade_hashes
+
+# writes everything UltrametricSample parsed from an MCMC sample, so it can be loaded without re-parsing
+# if include_nodes is False, the number of nodes and sum of node heights of each clade are written instead of
+# the node array, so the file size depends on the number of unique clades rather than on the number of trees
+def save_sample(sample, file_path, header = {}, include_nodes = True):
+	n_taxa = len(sample.taxon_order)
+	clade_ids = sample.clade_ids
+
+	sorted_topologies = sorted(sample.topology_counts)
+	topology_clades = numpy.array([[clade_ids[clade_hash] for clade_hash in topology_hash] for topology_hash in sorted_topologies], dtype = numpy.int32).reshape(len(sorted_topologies), n_taxa - 1)
+	topology_splits = numpy.array([[clade_ids[split_hash] for split_hash in sample.topology_splits[topology_hash]] for topology_hash in sorted_topologies], dtype = numpy.int32).reshape(len(sorted_topologies), n_taxa - 1)
+	topology_counts = numpy.array([sample.topology_counts[topology_hash] for topology_hash in sorted_topologies], dtype = numpy.int64)
+	newick_lengths = [len(sample.topology_newicks[topology_hash]) for topology_hash in sorted_topologies]
+	newick_blob = "".join([sample.topology_newicks[topology_hash] for topology_hash in sorted_topologies])
+
+	cc_rows = []
+	for parent_hash in sorted(sample.cc_counts):
+		split_counts = sample.cc_counts[parent_hash]
+		for split_hash in sorted(split_counts):
+			cc_rows.append((clade_ids[parent_hash], clade_ids[split_hash], split_counts[split_hash]))
+
+	cc_array = numpy.array(cc_rows, dtype = "i4,i4,i8")
+	sized_clades = numpy.array(sorted([clade_ids[clade_hash] for clade_hash in sample.clade_sizes]), dtype = numpy.int32)
+
+	arrays = {
+		"clade_bytes": clades_to_bytes(sample.clade_hashes, n_taxa),
+		"topology_clades": topology_clades,
+		"topology_splits": topology_splits,
+		"topology_counts": topology_counts,
+		"newick_offsets": numpy.cumsum([0] + newick_lengths).astype(numpy.int64),
+		"newick_blob": numpy.frombuffer(newick_blob, dtype = numpy.uint8),
+		"cc_array": cc_array,
+		"sized_clades": sized_clades,
+	}
+
+	arrays["leaf_height_sums"] = sample.leaf_height_sums
+
+	if include_nodes:
+		arrays["node_array"] = sample.node_array
+		arrays["tree_offsets"] = sample.tree_offsets
+		arrays["clade_height_counts"] = sample.clade_height_counts
+		arrays["clade_height_sums"] = sample.clade_height_sums
+	else:
+		height_counts, height_sums = sample.calculate_height_accumulators()
+		height_clades = sorted(height_counts)
+		arrays["height_clades"] = numpy.array([clade_ids[clade_hash] for clade_hash in height_clades], dtype = numpy.int32)
+		arrays["height_counts"] = numpy.array([height_counts[clade_hash] for clade_hash in height_clades], dtype = numpy.int64)
+		arrays["height_sums"] = numpy.array([height_sums[clade_hash] for clade_hash in height_clades], dtype = numpy.float64)
+
+	header = dict(header)
+	header["taxon_order"] = sample.taxon_order
+	header["n_trees"] = sample.n_trees
+
+	write_array_file(file_path, header, arrays)
+
+# returns an UltrametricSample read from a file written by save_sample, with its node array memory-mapped
+# and the file header (including anything passed to save_sample)
+def load_sample(file_path):
+	header, arrays = read_array_file(file_path)
+
+	sample = UltrametricSample([], "", 0.0)
+	sample.taxon_order = [taxon_name.encode("utf-8") for taxon_name in header["taxon_order"]] # JSON decodes names to unicode
+	sample.taxon_indices = calculate_taxon_indices(sample.taxon_order)
+	sample.n_trees = header["n_trees"]
+	sample.leaf_height_sums = numpy.array(arrays["leaf_height_sums"]) # copied, as it is added to by merges
+
+	sample.clade_hashes = clades_from_bytes(arrays["clade_bytes"])
+	sample.clade_ids = {}
+	for i in range(len(sample.clade_hashes)):
+		sample.clade_ids[sample.clade_hashes[i]] = i
+
+	clade_hashes = sample.clade_hashes
+	if "node_array" in arrays:
+		sample.node_buffer = arrays["node_array"]
+		sample.node_array = sample.node_buffer
+		sample.clade_height_counts = numpy.array(arrays["clade_height_counts"]) # copied, as trees may be added
+		sample.clade_height_sums = numpy.array(arrays["clade_height_sums"])
+		sample.tree_offsets = arrays["tree_offsets"]
+	else: # written without nodes, so only the node height accumulators of each clade are available
+		sample.height_counts = {}
+		sample.height_sums = {}
+		for clade_id, height_count, height_sum in zip(arrays["height_clades"].tolist(), arrays["height_counts"].tolist(), arrays["height_sums"].tolist()):
+			sample.height_counts[clade_hashes[clade_id]] = height_count
+			sample.height_sums[clade_hashes[clade_id]] = height_sum
+
+	# converted to lists first, as indexing memory-mapped arrays one element at a time is slow
+	newick_offsets = arrays["newick_offsets"].tolist()
+	newick_blob = arrays["newick_blob"].tostring()
+	topology_clades = arrays["topology_clades"].tolist()
+	topology_splits = arrays["topology_splits"].tolist()
+	topology_counts = arrays["topology_counts"].tolist()
+	for i in range(len(topology_counts)):
+		# clade IDs are stored in topology hash order, with the ID of each clade's split in the same position
+		topology_hash = tuple([clade_hashes[clade_id] for clade_id in topology_clades[i]])
+		sample.topology_splits[topology_hash] = tuple([clade_hashes[split_id] for split_id in topology_splits[i]])
+		sample.topology_counts[topology_hash] = topology_counts[i]
+		sample.topology_newicks[topology_hash] = newick_blob[newick_offsets[i]:newick_offsets[i + 1]]
+
+	for parent_id, split_id, split_count in arrays["cc_array"].tolist():
+		parent_hash = clade_hashes[parent_id]
+		if parent_hash not in sample.cc_counts:
+			sample.cc_counts[parent_hash] = {}
+
+		sample.cc_counts[parent_hash][clade_hashes[split_id]] = split_count
+
+	for clade_id in arrays["sized_clades"].tolist():
+		clade_hash = clade_hashes[clade_id]
+		sample.clade_sizes[clade_hash] = clade_size(clade_hash)
+
+	return sample, header
+
+# saves the counts of a sample without its node array, to be merged with the counts of other samples by merge_counts
+# settings are the reading settings of the sample from sample_settings, and only counts read with the same settings
+# can be merged
+def save_counts(sample, counts_path, settings):
+	save_sample(sample, counts_path, {"content": "counts", "version": cache_format_version, "settings": settings}, include_nodes = False)
+
+# returns the merged counts of files written by save_counts, as one sample with node height accumulators, and the
+# reading settings of the merged counts. only the calibration settings affect node heights, so only they must be
+# the same for every file. independent chains may need different burn-in and thinning, and merged counts are
+# simply sums over the trees kept from each chain, so the merged settings list the burn-in and thinning of each
+# chain instead (files which were themselves merged add one entry for each of their chains)
+# raises ValueError if a file is not a counts file, or was read with different calibration settings
+def merge_counts(counts_paths):
+	merged_sample = UltrametricSample([], "", 0.0)
+	merged_settings = None
+	for counts_path in counts_paths:
+		sample, header = load_sample(counts_path)
+		if (header.get("content") != "counts") or (header.get("version") != cache_format_version) or ("settings" not in header):
+			raise ValueError("Not a SCCULS counts file, or written by another version: " + counts_path)
+
+		settings = header["settings"]
+		if merged_settings is None:
+			merged_settings = {
+				"burn_in": [],
+				"thinning": [],
+				"calibration_taxon": settings["calibration_taxon"],
+				"calibration_date": settings["calibration_date"],
+			}
+		elif (settings["calibration_taxon"] != merged_settings["calibration_taxon"]) or (settings["calibration_date"] != merged_settings["calibration_date"]):
+			raise ValueError("Counts files read with different calibration settings cannot be merged: " + counts_path)
+
+		for setting_name in ("burn_in", "thinning"):
+			if isinstance(settings[setting_name], list):
+				merged_settings[setting_name].extend(settings[setting_name])
+			else:
+				merged_settings[setting_name].append(settings[setting_name])
+
+		merged_sample.merge_counts(sample)
+
+	return merged_sample, merged_settings
+
+# the settings used to read a sample, which must match for parsed samples to be reused or counts to be merged
+def sample_settings(burn_in, thinning, calibration_taxon, calibration_date):
+	settings = {
+		"burn_in": burn_in,
+		"thinning": thinning,
+		"calibration_taxon": calibration_taxon,
+		"calibration_date": calibration_date,
+	}
+
+	return settings
+
+# identifies a parsed sample by the settings used to read it and by the input file itself. to avoid reading
+# the whole input file, its content is identified by its size, modification time and a hash of its first and
+# last megabytes. if any of these change the cache key changes, and the old cache file is no longer used
+def sample_cache_key(sample_path, burn_in, thinning, calibration_taxon, calibration_date):
+	block_size = 1 << 20
+	sample_stat = os.stat(sample_path)
+
+	sample_hash = hashlib.sha1()
+	sample_file = open(sample_path, "rb")
+	sample_hash.update(sample_file.read(block_size))
+	if sample_stat.st_size > block_size:
+		sample_file.seek(max(block_size, sample_stat.st_size - block_size))
+		sample_hash.update(sample_file.read(block_size))
+	sample_file.close()
+
+	file_key = {
+		"version": cache_format_version,
+		"size": sample_stat.st_size,
+		"mtime": sample_stat.st_mtime,
+		"hash": sample_hash.hexdigest(),
+	}
+
+	settings_key = sample_settings(burn_in, thinning, calibration_taxon, calibration_date)
+
+	cache_key = {"file": file_key, "settings": settings_key}
+
+	return cache_key
+
+# cache files are named after the input file and digests of its absolute path and of the file and settings keys,
+# so caches of the same input with different settings can coexist, and inputs with the same file name in different
+# folders never share caches. by default they are stored in the same folder as the input file
+def sample_cache_path(sample_path, cache_key, cache_folder = None):
+	sample_folder, sample_file_name = os.path.split(os.path.abspath(sample_path))
+	if cache_folder is None:
+		cache_folder = sample_folder
+
+	path_digest = hashlib.sha1(os.path.abspath(sample_path)).hexdigest()[:12]
+	file_digest = hashlib.sha1(json.dumps(cache_key["file"], sort_keys = True)).hexdigest()[:12]
+	settings_digest = hashlib.sha1(json.dumps(cache_key["settings"], sort_keys = True)).hexdigest()[:12]
+	cache_file_name = "%s.%s.%s.%s.scculs-cache" % (sample_file_name, path_digest, file_digest, settings_digest)
+
+	return os.path.join(cache_folder, cache_file_name)
+
+# returns the cached sample, or None if there is no valid cache file
+def load_sample_cache(cache_path, cache_key):
+	if not os.path.isfile(cache_path):
+		return None
+
+	try:
+		sample, header = load_sample(cache_path)
+	except (IOError, ValueError, KeyError):
+		return None
+
+	if header.get("cache_key") != json.loads(json.dumps(cache_key)):
+		return None
+
+	return sample
+
+# the cache file is written under a temporary name then renamed, so an interrupted run never leaves a truncated
+# cache file. cache files of the same input path with a different file digest are stale (the input file has
+# changed since they were written, or they were written by another version) and are removed
+def save_sample_cache(sample, cache_path, cache_key):
+	cache_folder, cache_file_name = os.path.split(cache_path)
+	sample_file_name, path_digest, file_digest, settings_digest, cache_suffix = cache_file_name.rsplit(".", 4)
+
+	temporary_path = cache_path + ".tmp%d" % (os.getpid())
+	save_sample(sample, temporary_path, {"cache_key": cache_key})
+	os.rename(temporary_path, cache_path)
+
+	for file_name in os.listdir(cache_folder):
+		name_parts = file_name.rsplit(".", 4)
+		if (len(name_parts) == 5) and (name_parts[0] == sample_file_name) and (name_parts[1] == path_digest) and (name_parts[4] == cache_suffix) and (name_parts[2] != file_digest):
+			os.remove(os.path.join(cache_folder, file_name))
+
+# groups the items of an iterable into lists of up to chunk_size items
+def iterate_chunks(iterable, chunk_size):
+	chunk = []
+	for item in iterable:
+		chunk.append(item)
+		if len(chunk) == chunk_size:
+			yield chunk
+			chunk = []
+
+	if len(chunk) > 0:
+		yield chunk
+
+# like pool.imap, but at most max_pending tasks are submitted ahead of the results being consumed
+# so a lazily read sample is never read into memory faster than it can be processed
+def ordered_pool_map(pool, function, arguments, max_pending):
+	pending_results = collections.deque()
+	for argument in arguments:
+		pending_results.append(pool.apply_async(function, (argument,)))
+		if len(pending_results) >= max_pending:
+			yield pending_results.popleft().get()
+
+	while len(pending_results) > 0:
+		yield pending_results.popleft().get()
+
+# returns a dictionary mapping each taxon name to its position in the taxon order
+def calculate_taxon_indices(taxon_order):
+	taxon_indices = {}
+	for i in range(len(taxon_order)):
+		taxon_indices[taxon_order[i]] = i
+
+	return taxon_indices
+
+# the name of a leaf or node label token, without quotes, and with doubled quotes within it unescaped
+def newick_label(token):
+	label = token.strip()
+	if len(label) >= 2 and label[0] == "'" and label[-1] == "'":
+		label = label[1:-1].replace("''", "'")
+
+	return label
+
+# reads a newick string one token at a time, and yields an (event, value) pair for each part of the tree:
+# ("open", None) and ("close", None) for the brackets of each internal node, ("comma", None) between siblings,
+# ("leaf", name) for each leaf, ("label", name) for each internal node label (which follows its closing bracket)
+# and ("length", text) for each branch length, after the leaf or label of its node. names are unquoted by
+# newick_label, and comments, whitespace and the closing semicolon are skipped
+def iterate_newick_events(newick_string):
+	expect_leaf = True
+	for token in newick_token_regex.findall(newick_string):
+		first_char = token[0]
+		if first_char == ":": # the most common token, so checked first
+			yield "length", token[1:]
+		elif first_char == "(":
+			expect_leaf = True
+			yield newick_open_event
+		elif first_char == ",":
+			expect_leaf = True
+			yield newick_comma_event
+		elif first_char == ")":
+			expect_leaf = False
+			yield newick_close_event
+		elif first_char == "[" or first_char == ";" or token.isspace():
+			pass
+		elif expect_leaf:
+			expect_leaf = False
+			yield "leaf", newick_label(token)
+		else:
+			yield "label", newick_label(token)
 
-			i += 1
+# returns the taxon names of a newick string, in the order they appear
+def newick_taxon_names(newick_string):
+	taxon_names = [value for event, value in iterate_newick_events(newick_string) if event == "leaf"]
 
-	parent_packed = numpy.packbits(parent_boolean)
-	split_packed = numpy.packbits(split_boolean)
+	return taxon_names
 
-	parent_id = parent_packed.tostring()
-	split_id = split_packed.tostring()
+# the equivalent of ete2 format 9, a newick string with leaf names only
+# (no branch lengths, internal node labels or comments), where leaf names are quoted if they need to be
+def newick_topology(newick_string):
+	topology_tokens = []
+
+	for event, value in iterate_newick_events(newick_string):
+		if event == "open":
+			topology_tokens.append("(")
+		elif event == "comma":
+			topology_tokens.append(",")
+		elif event == "close":
+			topology_tokens.append(")")
+		elif event == "leaf":
+			topology_tokens.append(newick_quote(value))
+
+	topology_tokens.append(";")
+	return "".join(topology_tokens)
+
+# adds clade probabilities as internal node labels to a newick string with leaf names only, in one post-order
+# pass where the bitset of each clade is combined from its children's bitsets as the clade is closed
+# the output is the equivalent of ete2 format 2, with every branch length set to 1, replacing any node labels
+def newick_with_support(newick_string, clade_probabilities, taxon_indices):
+	support_tokens = []
+	open_clades = [] # the bitsets of the clades that have been opened but not yet closed
+
+	for event, value in iterate_newick_events(newick_string):
+		if event == "open":
+			open_clades.append(0)
+			support_tokens.append("(")
+		elif event == "comma":
+			support_tokens.append(",")
+		elif event == "close":
+			clade_hash = open_clades.pop()
+			support_tokens.append(")")
+			if len(open_clades) > 0: # the root node is not labelled
+				support_tokens.append("%0.6g:1" % (clade_probabilities[clade_hash]))
+				open_clades[-1] |= clade_hash
+		elif event == "leaf":
+			open_clades[-1] |= 1 << taxon_indices[value]
+			support_tokens.append(newick_quote(value) + ":1")
+
+	support_tokens.append(";")
+	return "".join(support_tokens)
+
+# replaces the branch lengths of a newick string in one post-order pass, keeping leaf names and internal node labels
+# the length of each branch is only known once its parent is closed, so branch length tokens are filled in then
+def newick_with_heights(newick_string, clade_heights, taxon_indices, leaf_heights):
+	height_tokens = []
+	open_children = [] # for each open clade, the (token index, clade bitset, height) of each closed child
+
+	for event, value in iterate_newick_events(newick_string):
+		if event == "open":
+			open_children.append([])
+			height_tokens.append("(")
+		elif event == "comma":
+			height_tokens.append(",")
+		elif event == "close":
+			children = open_children.pop()
+			clade_hash = 0
+			node_height = float("-inf")
+			for length_index, child_hash, child_height in children:
+				clade_hash |= child_hash
+				node_height = max(node_height, child_height)
+
+			node_height = max(node_height, clade_heights.get(clade_hash, node_height))
+			for length_index, child_hash, child_height in children:
+				height_tokens[length_index] = ":%0.6g" % (node_height - child_height)
+
+			height_tokens.append(")")
+			height_tokens.append("") # the root node has no branch, so its branch length stays empty
+			if len(open_children) > 0:
+				open_children[-1].append((len(height_tokens) - 1, clade_hash, node_height))
+		elif event == "leaf":
+			height_tokens.append(newick_quote(value))
+			height_tokens.append("")
+			open_children[-1].append((len(height_tokens) - 1, 1 << taxon_indices[value], leaf_heights[value]))
+		elif event == "label": # follows the closing bracket, so goes before the branch length
+			height_tokens[-2] += newick_quote(value)
+
+	height_tokens.append(";")
+	return "".join(height_tokens)
+
+# single pass reader for strictly bifurcating newick trees, child clade bitsets are combined bottom-up as each
+# internal node is closed, so no tree objects are built and leaf names are never collected more than once
+# returns one (parent_id, split_id) row per internal node in post-order, or (parent_id, split_id, node_height)
+# rows when a calibration taxon is given. leaves are not rows, but if leaf_height_sums is given (with a calibration
+# taxon) the height of each leaf is added to it at the index of its taxon
+def newick_node_values(newick_string, taxon_indices, calibration_taxon = None, calibration_date = 0.0, leaf_height_sums = None):
+	node_clades = [] # clade bitset of every node, in post-order
+	node_lengths = []
+	node_parents = []
+	internal_nodes = []
+	leaf_nodes = [] # (node, taxon index) of every leaf
+	node_values = []
+
+	open_children = [] # stack of child node lists, one for each internal node which has not yet been closed
+	previous_node = None
+	for event, value in iterate_newick_events(newick_string):
+		if event == "length": # the most common event, so checked first
+			node_lengths[previous_node] = float(value)
+		elif event == "open":
+			open_children.append([])
+		elif event == "close":
+			child1, child2 = open_children.pop() # assumes strictly bifurcating tree
+			parent_id, split_id = calculate_node_hashes(node_clades[child1], node_clades[child2])
+
+			previous_node = len(node_clades)
+			node_clades.append(parent_id)
+			node_lengths.append(0.0)
+			node_parents.append(None)
+			node_parents[child1] = previous_node
+			node_parents[child2] = previous_node
+
+			internal_nodes.append(previous_node)
+			node_values.append((parent_id, split_id))
+
+			if len(open_children) > 0:
+				open_children[-1].append(previous_node)
+		elif event == "leaf":
+			leaf_clade = 1 << taxon_indices[value]
+			if value == calibration_taxon:
+				calibration_node = len(node_clades)
+
+			previous_node = len(node_clades)
+			leaf_nodes.append((previous_node, taxon_indices[value]))
+			node_clades.append(leaf_clade)
+			node_lengths.append(0.0)
+			node_parents.append(None)
+
+			open_children[-1].append(previous_node)
+
+	if calibration_taxon is None:
+		return node_values
+
+	# children are always closed before their parents, so in reverse order every parent precedes its children
+	n_nodes = len(node_clades)
+	node_depths = [0.0] * n_nodes
+	for node in range(n_nodes - 2, -1, -1):
+		node_depths[node] = node_depths[node_parents[node]] + node_lengths[node]
+
+	root_height = node_depths[calibration_node] + calibration_date
+
+	tree_values = []
+	for i in range(len(internal_nodes)):
+		parent_id, split_id = node_values[i]
+		node_height = root_height - node_depths[internal_nodes[i]]
+		tree_values.append((parent_id, split_id, node_height))
+
+	if leaf_height_sums is not None:
+		for leaf_node, taxon_index in leaf_nodes:
+			leaf_height_sums[taxon_index] += root_height - node_depths[leaf_node]
+
+	return tree_values
+
+# clades are integer bitsets, where bit i is set when taxon i (in taxon order) is a member of the clade
+# a split is identified by the child clade containing the first taxon of the parent clade (the lowest set bit)
+def calculate_node_hashes(child1_clade, child2_clade):
+	parent_id = child1_clade | child2_clade
+	first_taxon = parent_id & -parent_id
+
+	if child1_clade & first_taxon: # first child always "True"
+		split_id = child1_clade
+	else:
+		split_id = child2_clade
 
 	return parent_id, split_id
 
 def clade_size(clade_hash):
-	clade_node_bytes = numpy.array(tuple(clade_hash)).view(dtype = numpy.uint8)
-	clade_node_bits = numpy.unpackbits(clade_node_bytes)
-	n_clade_taxa = sum(clade_node_bits)
+	n_clade_taxa = bin(clade_hash).count("1")
 
 	return n_clade_taxa
 
-def calculate_topology_probabilities(ts):
+# parses a chunk of newick strings into a node array, counts the topologies, conditional clades and clades
+# they contain and sums the heights of each taxon's leaf. module level so it can be run in a worker process, with
+# arguments packed into one tuple
+# clade IDs in the node array are local to the chunk, and index into the returned list of clade hashes
+def process_sample_chunk(chunk_arguments):
+	newick_strings, taxon_order, calibration_taxon, calibration_date = chunk_arguments
+	taxon_indices = calculate_taxon_indices(taxon_order)
+
+	clade_hashes = []
+	clade_ids = {}
+	node_values = []
+	leaf_height_sums = numpy.zeros(len(taxon_order), dtype = numpy.float64)
+	for newick_string in newick_strings:
+		for parent_hash, split_hash, node_height in newick_node_values(newick_string, taxon_indices, calibration_taxon, calibration_date, leaf_height_sums):
+			if parent_hash not in clade_ids:
+				clade_ids[parent_hash] = len(clade_hashes)
+				clade_hashes.append(parent_hash)
+
+			if split_hash not in clade_ids:
+				clade_ids[split_hash] = len(clade_hashes)
+				clade_hashes.append(split_hash)
+
+			node_values.append((clade_ids[parent_hash], clade_ids[split_hash], node_height))
+
+	node_array = numpy.array(node_values, dtype = node_struct_format)
+	topology_trees, topology_splits, topology_counts, cc_counts, clade_sizes = count_node_array(node_array, clade_hashes, len(taxon_order))
+
+	topology_newicks = {}
+	for topology_hash, first_tree in topology_trees.items():
+		topology_newicks[topology_hash] = newick_topology(newick_strings[first_tree]) # strip branch lengths
+
+	return clade_hashes, node_array, topology_newicks, topology_splits, topology_counts, cc_counts, clade_sizes, leaf_height_sums
+
+# counts topologies, conditional clades and clades of a node array with vectorized sorts, instead of tree by tree
+# returns dictionaries keyed by clade hashes, the first tree of each topology and the splits of each topology
+def count_node_array(node_array, clade_hashes, n_taxa):
+	n_nodes = n_taxa - 1
+	n_trees = len(node_array) // n_nodes
+
+	# two trees share a topology when their sorted rows of clade IDs are identical, so each row of
+	# clade IDs is viewed as a single opaque value to find the unique topologies in one pass
+	clade_matrix = numpy.sort(node_array["f0"].reshape(n_trees, n_nodes), axis = 1)
+	row_dtype = numpy.dtype((numpy.void, clade_matrix.dtype.itemsize * n_nodes))
+	clade_rows = numpy.ascontiguousarray(clade_matrix).view(row_dtype).ravel()
+	unique_rows, first_trees, unique_counts = numpy.unique(clade_rows, return_index = True, return_counts = True)
+
+	topology_trees = {}
+	topology_splits = {}
 	topology_counts = {}
-	topology_data = {}
-	cc_counts = {}
-	cc_data = {}
+	for i in range(len(unique_rows)):
+		first_tree = first_trees[i]
+		tree_nodes = node_array[first_tree * n_nodes:(first_tree + 1) * n_nodes]
+		tree_splits = sorted([(clade_hashes[parent_id], clade_hashes[split_id]) for parent_id, split_id in zip(tree_nodes["f0"].tolist(), tree_nodes["f1"].tolist())])
+		topology_hash = tuple([parent_hash for parent_hash, split_hash in tree_splits]) # topology hash is a tuple of sorted clade hashes
+		topology_trees[topology_hash] = first_tree
+		topology_splits[topology_hash] = tuple([split_hash for parent_hash, split_hash in tree_splits])
+		topology_counts[topology_hash] = int(unique_counts[i])
+
 	clade_sizes = {}
+	unique_parents = numpy.unique(node_array["f0"])
+	for parent_id in unique_parents:
+		parent_hash = clade_hashes[parent_id]
+		clade_sizes[parent_hash] = clade_size(parent_hash)
 
-	for i in range(ts.n_trees):
-		tree_array = ts.tree_arrays[i]
-		topology_hash = tree_array["f0"].tostring() # topology hash is concatenated, sorted clade hashes
+	# pairs of (clade ID, split ID) are combined into one integer key to count conditional clades
+	n_clades = len(clade_hashes)
+	parent_sizes = numpy.zeros(n_clades, dtype = numpy.int32)
+	for parent_id in unique_parents:
+		parent_sizes[parent_id] = clade_sizes[clade_hashes[parent_id]]
 
-		if topology_hash not in topology_counts: # record topology
-			tree_newick = ts.newick_strings[i]
-			tree_root = ete2.Tree(tree_newick)
-			topology_newick = tree_root.write(format = 9) # strip branch lengths
-			topology_data[topology_hash] = topology_newick
-			topology_counts[topology_hash] = 1
+	cc_nodes = node_array[parent_sizes[node_array["f0"]] >= 3]
+	cc_keys = cc_nodes["f0"].astype(numpy.int64) * n_clades + cc_nodes["f1"]
+	unique_keys, unique_counts = numpy.unique(cc_keys, return_counts = True)
+
+	cc_counts = {}
+	for i in range(len(unique_keys)):
+		parent_id, split_id = divmod(int(unique_keys[i]), n_clades)
+		parent_hash = clade_hashes[parent_id]
+		split_hash = clade_hashes[split_id]
+		if parent_hash not in cc_counts:
+			cc_counts[parent_hash] = {split_hash: int(unique_counts[i])}
 		else:
-			topology_counts[topology_hash] += 1
-
-		topology_array = tree_array[["f0", "f1"]] # we are only interested in clade & split hashes, not node heights
-		for node in topology_array:
-			parent_hash = node[0].tostring() # the hash for the clade
-			split_hash = node[1].tostring() # the hash for the bifurcation
-
-			n_node_taxa = clade_size(parent_hash)
-			clade_sizes[parent_hash] = n_node_taxa
-			if n_node_taxa >= 3: # record conditional clade
-				if parent_hash not in cc_counts:
-					cc_data[parent_hash] = {split_hash: node}
-					cc_counts[parent_hash] = {split_hash: 1}
-				elif split_hash not in cc_counts[parent_hash]:
-					cc_data[parent_hash][split_hash] = node
-					cc_counts[parent_hash][split_hash] = 1
-				else:
-					cc_counts[parent_hash][split_hash] += 1
+			cc_counts[parent_hash][split_hash] = int(unique_counts[i])
+
+	return topology_trees, topology_splits, topology_counts, cc_counts, clade_sizes
+
+# an existing conditional clade table for the same sample may be passed as cc_set, so it is not rebuilt
+def calculate_topology_probabilities(ts, cc_set = None):
+	topology_counts = ts.topology_counts
+	n_taxa = len(ts.taxon_order)
+
+	clades_set = CladeProbabilities(ts.clade_sizes)
+	topology_set = TopologyProbabilities(ts.topology_newicks, ts.topology_splits)
+	if cc_set is None:
+		cc_set = ConditionalCladeProbabilities(ts.cc_counts, n_taxa)
+
+	return topology_set, topology_counts, cc_set, clades_set
+
+# summarizes the heights of the given clades over every tree in the sample where they are a node, by their
+# "mean" or "median". means are calculated from the height accumulators the sample keeps for each clade, and
+# for medians the node array is read height_chunk_rows rows at a time
+# medians need a second pass. the medians of clades with at most height_sketch_bins heights are always exact, as
+# keeping their heights takes no more memory than a histogram. the medians of more often sampled clades are
+# estimated from a histogram of height_sketch_bins bins between each clade's lowest and highest heights, which
+# only needs a fixed amount of memory per clade. if exact is True, every height of the given clades is kept in
+# memory instead, and every median is calculated exactly. samples merged by
+# merge_counts have no node array, so only their means can be calculated
+# returns a dictionary of clade hash to height, which only contains clades found in the sample
+def calculate_clade_heights(sample, clade_hashes, method, exact = False):
+	if sample.height_sums is not None: # merged samples only keep the number of nodes and sum of heights of each clade
+		if method != "mean":
+			raise ValueError("Only mean node heights can be calculated from merged counts")
+
+		clade_heights = {}
+		for clade_hash in clade_hashes:
+			if clade_hash in sample.height_sums:
+				clade_heights[clade_hash] = sample.height_sums[clade_hash] / sample.height_counts[clade_hash]
+
+		return clade_heights
+
+	# single taxa are never nodes, and so have no heights
+	sampled_hashes = sorted(set([clade_hash for clade_hash in clade_hashes if (clade_hash in sample.clade_ids) and (clade_hash in sample.clade_sizes)]))
+	n_clades = len(sampled_hashes)
+
+	if method == "mean":
+		clade_heights = {}
+		for clade_hash in sampled_hashes:
+			clade_id = sample.clade_ids[clade_hash]
+			clade_heights[clade_hash] = float(sample.clade_height_sums[clade_id] / sample.clade_height_counts[clade_id])
+
+		return clade_heights
+	elif n_clades == 0:
+		return {}
+
+	# index of each summarized clade, from sample clade ID
+	clade_indices = numpy.zeros(len(sample.clade_hashes), dtype = numpy.int64) - 1
+	for i in range(n_clades):
+		clade_indices[sample.clade_ids[sampled_hashes[i]]] = i
+
+	height_counts = numpy.zeros(n_clades, dtype = numpy.int64)
+	min_heights = numpy.zeros(n_clades, dtype = numpy.float64) + numpy.inf
+	max_heights = numpy.zeros(n_clades, dtype = numpy.float64) - numpy.inf
+	for node_indices, node_heights in iterate_node_heights(sample.node_array, clade_indices):
+		height_counts += numpy.bincount(node_indices, minlength = n_clades)
+		numpy.minimum.at(min_heights, node_indices, node_heights)
+		numpy.maximum.at(max_heights, node_indices, node_heights)
+
+	if exact:
+		exact_clades = numpy.ones(n_clades, dtype = numpy.bool_)
+	else:
+		exact_clades = height_counts <= height_sketch_bins
+
+	bin_widths = (max_heights - min_heights) / height_sketch_bins
+	height_histograms = numpy.zeros(n_clades * height_sketch_bins, dtype = numpy.int64)
+	exact_indices = []
+	exact_heights = []
+	for node_indices, node_heights in iterate_node_heights(sample.node_array, clade_indices):
+		exact_nodes = exact_clades[node_indices]
+		exact_indices.append(node_indices[exact_nodes])
+		exact_heights.append(node_heights[exact_nodes])
+
+		node_indices = node_indices[~exact_nodes]
+		node_heights = node_heights[~exact_nodes]
+		node_widths = bin_widths[node_indices]
+		node_bins = numpy.zeros(len(node_indices), dtype = numpy.int64)
+		binned_nodes = node_widths > 0.0
+		node_bins[binned_nodes] = (node_heights[binned_nodes] - min_heights[node_indices[binned_nodes]]) / node_widths[binned_nodes]
+		node_bins = numpy.minimum(node_bins, height_sketch_bins - 1)
+		height_histograms += numpy.bincount(node_indices * height_sketch_bins + node_bins, minlength = n_clades * height_sketch_bins)
+
+	summary_heights = numpy.zeros(n_clades, dtype = numpy.float64)
+
+	exact_indices = numpy.concatenate(exact_indices)
+	exact_heights = numpy.concatenate(exact_heights)
+	height_order = numpy.lexsort((exact_heights, exact_indices))
+	sorted_heights = exact_heights[height_order]
+
+	# heights of each clade are contiguous once sorted, so the middle one or two of each clade are picked
+	exact_counts = numpy.where(exact_clades, height_counts, 0)
+	clade_starts = numpy.cumsum(exact_counts) - exact_counts
+	exact_ids = numpy.flatnonzero(exact_clades)
+	lower_middles = sorted_heights[clade_starts[exact_ids] + (height_counts[exact_ids] - 1) // 2]
+	upper_middles = sorted_heights[clade_starts[exact_ids] + height_counts[exact_ids] // 2]
+	summary_heights[exact_ids] = (lower_middles + upper_middles) / 2.0
+
+	# like exact medians, the estimated median of an even number of heights is the mean of the middle two
+	sketched_ids = numpy.flatnonzero(~exact_clades)
+	if len(sketched_ids) > 0:
+		sketched_histograms = height_histograms.reshape(n_clades, height_sketch_bins)[sketched_ids]
+		sketched_counts = height_counts[sketched_ids]
+		sketched_min_heights = min_heights[sketched_ids]
+		sketched_widths = bin_widths[sketched_ids]
+		lower_middles = sketch_rank_heights(sketched_histograms, sketched_min_heights, sketched_widths, (sketched_counts - 1) // 2)
+		upper_middles = sketch_rank_heights(sketched_histograms, sketched_min_heights, sketched_widths, sketched_counts // 2)
+		summary_heights[sketched_ids] = (lower_middles + upper_middles) / 2.0
+
+	clade_heights = {}
+	for i in range(n_clades):
+		clade_heights[sampled_hashes[i]] = float(summary_heights[i])
+
+	return clade_heights
+
+# estimates the height of the given (zero based) rank of each clade's heights from its histogram. the heights in
+# each bin are assumed to be evenly spread across it, so heights are interpolated within the bin of the rank
+def sketch_rank_heights(height_histograms, min_heights, bin_widths, ranks):
+	cumulative_counts = numpy.cumsum(height_histograms, axis = 1)
+	rank_bins = numpy.argmax(cumulative_counts > ranks[:, numpy.newaxis], axis = 1)
+	clade_range = numpy.arange(len(ranks))
+	bin_counts = height_histograms[clade_range, rank_bins]
+	counts_below = cumulative_counts[clade_range, rank_bins] - bin_counts
+	bin_fractions = (ranks - counts_below + 0.5) / bin_counts
+
+	return min_heights + (rank_bins + bin_fractions) * bin_widths
+
+# yields the summarized clade index and height of every node of a summarized clade, one chunk of rows at a time
+def iterate_node_heights(node_array, clade_indices):
+	for chunk_start in range(0, len(node_array), height_chunk_rows):
+		chunk_nodes = node_array[chunk_start:chunk_start + height_chunk_rows]
+		node_indices = clade_indices[chunk_nodes["f0"]]
+		summarized_nodes = node_indices >= 0
+		yield node_indices[summarized_nodes], chunk_nodes["f2"][summarized_nodes]
+
+# best-first search for the most probable topologies given conditional clade probabilities
+# the frontier is a heap of partial topologies keyed by log probability. partial topologies share structure,
+# each is a pair of linked lists (nested tuples) of unresolved clade IDs and of chosen split indices, so
+# expanding a partial topology only prepends to its parent's lists. only clades of three or more taxa are
+# ever unresolved, as single taxa and cherries can only be resolved one way
+# if prune_frontier is True, partial topologies which cannot be among the topologies_threshold most probable
+# topologies are periodically removed from the frontier, so its size stays bounded
+# if frontier_telemetry is a list, (iteration, frontier size, number of topologies found, total probability of
+# the frontier, total probability of the topologies found) is appended to it every frontier_telemetry_interval
+# iterations and after the last iteration
+def derive_best_topologies(cc_set, taxon_order, topologies_threshold, probability_threshold, prune_frontier = False, frontier_telemetry = None):
+	with numpy.errstate(divide = "ignore"):
+		log_split_probabilities = numpy.log(cc_set.split_probabilities)
+
+	if prune_frontier:
+		best_completions = best_log_completions(cc_set, log_split_probabilities)
+	else:
+		best_completions = numpy.zeros(cc_set.n_clades)
+
+	# heap entries are (negative log probability, tie breaker, unresolved clades, chosen splits, best completion)
+	# where the best completion is the log probability of the most probable way to resolve all unresolved clades
+	candidate_sequence = 0
+	root_unresolved = (cc_set.root_id, None)
+	candidate_heap = [(0.0, candidate_sequence, root_unresolved, None, best_completions[cc_set.root_id])]
+	candidates_probability = 1.0 # the total probability of all candidate topologies, for reporting
+	prune_size = 1024
 
-	clades_set = CladeProbabilities(clade_sizes)
-	topology_set = TopologyProbabilities(topology_data)
+	best_topologies = []
+	best_posterior = 0.0
+	iteration = 0
+	while (len(candidate_heap) > 0) and (len(best_topologies) < topologies_threshold) and (best_posterior < probability_threshold):
+		candidate_inv_log_prob, sequence, candidate_unresolved, candidate_splits, candidate_completion = heapq.heappop(candidate_heap)
+		candidate_log_probability = -candidate_inv_log_prob
+		candidates_probability -= math.exp(candidate_log_probability)
+
+		if candidate_unresolved is None: # candidate topology is fully resolved
+			best_topologies.append(candidate_splits)
+			best_posterior += math.exp(candidate_log_probability)
+		else: # candidate topology is not fully resolved
+			unresolved_node_id, remaining_unresolved = candidate_unresolved
+			remaining_completion = candidate_completion - best_completions[unresolved_node_id]
 
-	cc_sets = {}
-	for parent_hash, splits_data in cc_data.items():
-		cc_sets[parent_hash] = DiscreteProbabilities(splits_data)
+			for j in range(cc_set.split_offsets[unresolved_node_id], cc_set.split_offsets[unresolved_node_id + 1]):
+				if cc_set.split_probabilities[j] > 0.0:
+					child1_id = cc_set.split_child1[j]
+					child2_id = cc_set.split_child2[j]
 
-	return topology_set, topology_counts, cc_sets, cc_counts, clades_set
+					new_unresolved = remaining_unresolved
+					if cc_set.clade_sizes[child1_id] >= 3:
+						new_unresolved = (child1_id, new_unresolved)
+					if cc_set.clade_sizes[child2_id] >= 3:
+						new_unresolved = (child2_id, new_unresolved)
 
-def derive_best_topologies(cc_sets, taxon_order, topologies_threshold, probability_threshold):
-	cherry_hash = "\x80"
+					new_log_probability = candidate_log_probability + log_split_probabilities[j]
+					new_completion = remaining_completion + best_completions[child1_id] + best_completions[child2_id]
 
-	n_taxa = len(taxon_order)
-	root_hash = calculate_root_hash(n_taxa)
-	n_bytes = len(root_hash) # maximum number of bytes required to store parent clade hashes or split hashes
+					candidate_sequence += 1
+					heapq.heappush(candidate_heap, (-new_log_probability, candidate_sequence, new_unresolved, (j, candidate_splits), new_completion))
+					candidates_probability += math.exp(new_log_probability)
 
-	derived_struct_format = "a%d,a%d,u1,f8" % (n_bytes, n_bytes)
+			if prune_frontier and (len(candidate_heap) > prune_size):
+				candidate_heap = prune_candidates(candidate_heap, topologies_threshold - len(best_topologies))
+				prune_size = max(prune_size, len(candidate_heap) * 2)
+				candidates_probability = sum([math.exp(-candidate[0]) for candidate in candidate_heap])
 
-	star_tree = numpy.array([(root_hash, "", 1, 1.0)], dtype=derived_struct_format)
-	candidate_topologies = [star_tree]
-	candidate_inv_probs = [0.0]
+		if (frontier_telemetry is not None) and (iteration % frontier_telemetry_interval == 0):
+			frontier_telemetry.append((iteration, len(candidate_heap), len(best_topologies), candidates_probability, best_posterior))
 
-	best_topologies = []
-	best_posterior = 0.0
-	while (len(candidate_topologies) > 0) and (len(best_topologies) < topologies_threshold) and (best_posterior < probability_threshold):
-		candidate_topology = candidate_topologies.pop(0)
-		candidate_inv_prob = candidate_inv_probs.pop(0)
-		candidate_nodes = numpy.flatnonzero(candidate_topology["f2"])
-
-		if len(candidate_nodes) == 0: # candidate topology is fully resolved
-			candidate_probability = 1.0 - candidate_inv_prob
-			best_topologies.append(candidate_topology)
-			best_posterior += candidate_probability
-		else: # candidate topology is not fully resolved
-			unresolved_node_index = candidate_nodes[0]
-			unresolved_node_hash = candidate_topology[unresolved_node_index]["f0"].tostring()
-			split_probabilities = cc_sets[unresolved_node_hash].probabilities
-
-			new_candidate_topologies = []
-			new_candidate_inv_probs = []
-			for split_hash in split_probabilities:
-				split_probability = split_probabilities[split_hash]
-				if split_probability > 0.0:
-					child1_hash, child2_hash = elucidate_cc_split(unresolved_node_hash, split_hash)
-					child1_size = clade_size(child1_hash)
-					child2_size = clade_size(child2_hash)
-
-					new_topology_rows = []
-					if child1_size > 1:
-						if child1_size == 2: # resolved (cherry)
-							child1_row = numpy.array([(child1_hash, cherry_hash, 0, 1.0)], dtype=derived_struct_format)
-						else: # unresolved (more than two taxa)
-							child1_row = numpy.array([(child1_hash, "", 1, 1.0)], dtype=derived_struct_format)
-						new_topology_rows.append(child1_row)
-
-					if child2_size > 1:
-						if child2_size == 2: # resolved (cherry)
-							child2_row = numpy.array([(child2_hash, cherry_hash, 0, 1.0)], dtype=derived_struct_format)
-						else: # unresolved (more than two taxa)
-							child2_row = numpy.array([(child2_hash, "", 1, 1.0)], dtype=derived_struct_format)
-						new_topology_rows.append(child2_row)
-
-					new_topology = numpy.concatenate([candidate_topology] + new_topology_rows)
-					new_topology[unresolved_node_index]["f1"] = split_hash
-					new_topology[unresolved_node_index]["f2"] = 0
-					new_topology[unresolved_node_index]["f3"] = split_probability
-					new_candidate_topologies.append(new_topology)
-
-					new_topology_inv_probability = 1.0 - numpy.prod(new_topology["f3"])
-					new_candidate_inv_probs.append(new_topology_inv_probability)
-
-			integrate_probability(candidate_inv_probs, candidate_topologies, new_candidate_inv_probs, new_candidate_topologies)
-
-		print(len(candidate_topologies), len(best_topologies), sum([1.0 - p for p in candidate_inv_probs]), best_posterior) # number of candidate and best topologies, total posterior of candidate and best topologies
-
-	derived_topology_probabilities = {}
-	derived_topology_newick = {}
-	for i in range(len(best_topologies)):
-		topology = best_topologies[i]
-		topology_hash = numpy.sort(topology["f0"]).tostring()
+		iteration += 1
 
-		splits = {}
-		for node in topology:
-			parent_id = node["f0"]
-			split_id = node["f1"]
-			splits[parent_id] = split_id
+	if frontier_telemetry is not None:
+		frontier_telemetry.append((iteration, len(candidate_heap), len(best_topologies), candidates_probability, best_posterior))
 
-		tree_model = ete2.Tree()
-		derive_tree_from_splits(tree_model, root_hash, taxon_order, splits)
-		newick = tree_model.write(format = 9)
+	best_split_indices = []
+	for topology_splits in best_topologies:
+		split_indices = []
+		while topology_splits is not None:
+			j, topology_splits = topology_splits
+			split_indices.append(j)
 
-		derived_topology_newick[topology_hash] = newick
+		best_split_indices.append(split_indices)
 
-	derived_topologies = TopologyProbabilities(derived_topology_newick)
+	derived_topologies = derived_topology_set(cc_set, taxon_order, best_split_indices)
 
 	return derived_topologies
 
-def calculate_root_hash(n_taxa):
-	root_hash_bits = numpy.ones(n_taxa, dtype = numpy.uint8)
-	root_hash_bytes = numpy.packbits(root_hash_bits)
-	root_hash = root_hash_bytes.tostring()
-
-	return root_hash
+# derives the k most probable topologies exactly, without a search frontier
+# stops after topologies_threshold topologies, or once their total probability reaches probability_threshold
+# derivations found by earlier calls are reused when their TopologyDerivations is passed as topology_derivations
+def derive_kbest_topologies(cc_set, taxon_order, topologies_threshold, probability_threshold, topology_derivations = None):
+	if topology_derivations is None:
+		topology_derivations = TopologyDerivations(cc_set)
 
-def elucidate_cc_split(parent_id, split_id):
-	parent_id_bytes = numpy.array(tuple(parent_id)).view(dtype = numpy.uint8)
-	split_id_bytes = numpy.array(tuple(split_id)).view(dtype = numpy.uint8)
+	best_split_indices = []
+	best_posterior = 0.0
+	for log_probability, split_indices in topology_derivations.iterate_topologies():
+		best_split_indices.append(split_indices)
+		best_posterior += math.exp(log_probability)
 
-	parent_id_bits = numpy.unpackbits(parent_id_bytes)
-	split_id_bits = numpy.unpackbits(split_id_bytes)
+		if (len(best_split_indices) >= topologies_threshold) or (best_posterior >= probability_threshold):
+			break
 
-	n_parent_bits = len(parent_id_bits)
-	n_split_bits = len(split_id_bits)
+	derived_topologies = derived_topology_set(cc_set, taxon_order, best_split_indices)
 
-	child1_bits = numpy.zeros(n_parent_bits, dtype = numpy.uint8)
-	child2_bits = numpy.zeros(n_parent_bits, dtype = numpy.uint8)
+	return derived_topologies
 
-	j = 0
-	for i in range(n_parent_bits):
-		if parent_id_bits[i] == 1:
-			if j < n_split_bits:
-				if split_id_bits[j] == 1:
-					child1_bits[i] = 1
-				else:
-					child2_bits[i] = 1
+# lazy k-best enumeration over the conditional clade hypergraph, where derivation k of a clade is its k-th most
+# probable resolution: (log probability, split index, k of first child, k of second child). one bottom-up
+# max-product pass finds the most probable resolution of every clade (so the first topology is the exact
+# maximum a posteriori topology), then each further topology only requires the next derivations of the clades
+# it uses. the derivations found so far are kept, so when the probabilities of some clades change, only those
+# clades and their ancestors have to be resolved again
+class TopologyDerivations():
+	def __init__(self, cc_set):
+		self.cc_set = cc_set
+		with numpy.errstate(divide = "ignore"):
+			self.log_split_probabilities = numpy.log(cc_set.split_probabilities)
+
+		self.derivations = [None] * cc_set.n_clades # the best derivations found so far for each clade, in decreasing order
+		self.candidates = [None] * cc_set.n_clades # heaps of candidate derivations for each clade
+		self.visited = [None] * cc_set.n_clades # derivations which have already been added to the candidates of each clade
+
+		# clade IDs are ordered by size, so children are always resolved before their parents
+		for parent_id in range(cc_set.n_clades):
+			self.resolve_clade(parent_id)
+
+	# finds the most probable derivation of a clade, discarding any derivations found before
+	def resolve_clade(self, parent_id):
+		cc_set = self.cc_set
+		derivations = self.derivations
+
+		split_start = cc_set.split_offsets[parent_id]
+		split_end = cc_set.split_offsets[parent_id + 1]
+		if split_end == split_start: # single taxa and cherries can only be resolved one way
+			derivations[parent_id] = [(0.0, -1, 0, 0)]
+		else:
+			parent_candidates = []
+			for j in range(split_start, split_end):
+				child1_derivations = derivations[cc_set.split_child1[j]]
+				child2_derivations = derivations[cc_set.split_child2[j]]
+				if (cc_set.split_probabilities[j] > 0.0) and (len(child1_derivations) > 0) and (len(child2_derivations) > 0):
+					log_probability = self.log_split_probabilities[j] + child1_derivations[0][0] + child2_derivations[0][0]
+					parent_candidates.append((-log_probability, j, 0, 0))
+
+			heapq.heapify(parent_candidates)
+			self.visited[parent_id] = set([(candidate[1], 0, 0) for candidate in parent_candidates])
+
+			derivations[parent_id] = []
+			self.candidates[parent_id] = parent_candidates
+			if len(parent_candidates) > 0:
+				inv_log_probability, j, k1, k2 = heapq.heappop(parent_candidates)
+				derivations[parent_id].append((-inv_log_probability, j, k1, k2))
+
+	# resolves again the clades whose split probabilities have changed (in place, in the same conditional clade
+	# table) and all of their ancestors, which are found through the reverse index of the table
+	def update_clades(self, changed_ids):
+		cc_set = self.cc_set
+		cc_set.build_reverse_index()
+
+		for parent_id in changed_ids:
+			split_start = cc_set.split_offsets[parent_id]
+			split_end = cc_set.split_offsets[parent_id + 1]
+			with numpy.errstate(divide = "ignore"):
+				self.log_split_probabilities[split_start:split_end] = numpy.log(cc_set.split_probabilities[split_start:split_end])
+
+		affected_ids = set(changed_ids)
+		unvisited = list(changed_ids)
+		while len(unvisited) > 0:
+			child_id = unvisited.pop()
+			for r in range(cc_set.reverse_offsets[child_id], cc_set.reverse_offsets[child_id + 1]):
+				parent_id = cc_set.reverse_parents[r]
+				if parent_id not in affected_ids:
+					affected_ids.add(parent_id)
+					unvisited.append(parent_id)
+
+		for clade_id in sorted(affected_ids):
+			self.resolve_clade(clade_id)
+
+	# yields (log probability, split indices) for each topology in decreasing order of probability
+	def iterate_topologies(self):
+		cc_set = self.cc_set
+		derivations = self.derivations
+
+		k = 0
+		while next_derivation(cc_set, self.log_split_probabilities, derivations, self.candidates, self.visited, cc_set.root_id, k):
+			log_probability = derivations[cc_set.root_id][k][0]
+
+			split_indices = []
+			unexpanded = [(cc_set.root_id, k)]
+			while len(unexpanded) > 0:
+				clade_id, clade_k = unexpanded.pop()
+				derivation_log_probability, j, k1, k2 = derivations[clade_id][clade_k]
+				if j >= 0:
+					split_indices.append(j)
+					unexpanded.append((cc_set.split_child1[j], k1))
+					unexpanded.append((cc_set.split_child2[j], k2))
+
+			yield log_probability, split_indices
+
+			k += 1
+
+# makes sure derivation k of a clade has been found, and returns False if the clade has fewer than k + 1 derivations
+# finding a derivation may first require finding later derivations of its children, and of their children in turn.
+# a stack of frames is used instead of recursion, so deep trees (e.g. caterpillars of many taxa) never reach the
+# recursion limit. each frame is [clade ID, k, step, successor index], and the result of the last finished frame
+# is kept in child_found for the frame below it
+def next_derivation(cc_set, log_split_probabilities, derivations, candidates, visited, clade_id, k):
+	stack = [[clade_id, k, 0, 0]]
+	child_found = False
+	while len(stack) > 0:
+		frame = stack[-1]
+		frame_id, frame_k, step, successor_index = frame
+		clade_derivations = derivations[frame_id]
+		clade_candidates = candidates[frame_id]
+
+		if step == 0: # check whether derivation k has been found yet
+			if len(clade_derivations) > frame_k:
+				child_found = True
+				stack.pop()
+				continue
+			elif clade_candidates is None:
+				child_found = False
+				stack.pop()
+				continue
+
+			frame[2] = 1
+			frame[3] = 0
+			continue
+
+		# the successors of the last derivation use the next derivation of one of its children
+		last_log_probability, j, k1, k2 = clade_derivations[-1]
+		child1_id = cc_set.split_child1[j]
+		child2_id = cc_set.split_child2[j]
+		if successor_index == 0:
+			successor_k1, successor_k2 = k1 + 1, k2
+		else:
+			successor_k1, successor_k2 = k1, k2 + 1
+
+		if step == 1: # start on the next successor, by finding the derivation it needs from the first child
+			if successor_index == 2:
+				if len(clade_candidates) == 0:
+					child_found = False
+					stack.pop()
+					continue
+
+				inv_log_probability, j, k1, k2 = heapq.heappop(clade_candidates)
+				clade_derivations.append((-inv_log_probability, j, k1, k2))
+				frame[2] = 0
+			elif (j, successor_k1, successor_k2) in visited[frame_id]:
+				frame[3] = successor_index + 1
+			else:
+				frame[2] = 2
+				stack.append([child1_id, successor_k1, 0, 0])
+		elif step == 2: # the first child has been searched, so search the second child if it was found
+			if child_found:
+				frame[2] = 3
+				stack.append([child2_id, successor_k2, 0, 0])
 			else:
-				child2_bits[i] = 1
+				frame[2] = 1
+				frame[3] = successor_index + 1
+		else: # both children have been searched, so the successor is a candidate if both were found
+			if child_found:
+				log_probability = log_split_probabilities[j] + derivations[child1_id][successor_k1][0] + derivations[child2_id][successor_k2][0]
+				heapq.heappush(clade_candidates, (-log_probability, j, successor_k1, successor_k2))
+				visited[frame_id].add((j, successor_k1, successor_k2))
 
-			j += 1
+			frame[2] = 1
+			frame[3] = successor_index + 1
 
-	child1_bytes = numpy.packbits(child1_bits)
-	child2_bytes = numpy.packbits(child2_bits)
+	return child_found
 
-	child1_id = child1_bytes.tostring().rstrip("\x00") # urgh C (null terminated strings)
-	child2_id = child2_bytes.tostring().rstrip("\x00") # vs Python (not null terminated) strings
+# builds a topology set from lists of split indices, one list for each topology
+def derived_topology_set(cc_set, taxon_order, topologies_split_indices):
+	n_taxa = len(taxon_order)
+	root_hash = calculate_root_hash(n_taxa)
 
-	return child1_id, child2_id
+	derived_topology_newick = {}
+	derived_topology_splits = {}
+	for split_indices in topologies_split_indices:
+		splits = {}
+		for j in split_indices:
+			parent_hash = cc_set.clade_hashes[cc_set.split_parents[j]]
+			splits[parent_hash] = cc_set.clade_hashes[cc_set.split_child1[j]]
 
-def integrate_probability(original_probs, original_data, new_probs, new_data):
-	for i in range(len(new_probs)):
-		probability = new_probs[i]
-		observation = new_data[i]
+			for child_id in (cc_set.split_child1[j], cc_set.split_child2[j]):
+				if cc_set.clade_sizes[child_id] == 2: # cherries are split by their first taxon
+					cherry_hash = cc_set.clade_hashes[child_id]
+					splits[cherry_hash] = cherry_hash & -cherry_hash
 
-		rank = numpy.searchsorted(original_probs, probability)
+		topology_hash = tuple(sorted(splits))
 
-		original_probs.insert(rank, probability)
-		original_data.insert(rank, observation)
+		newick = newick_from_splits(root_hash, taxon_order, splits)
 
-def derive_tree_from_splits(current_node, parent_hash, taxon_order, splits):
-	split_hash = splits[parent_hash]
-	child1_hash, child2_hash = elucidate_cc_split(parent_hash, split_hash)
+		derived_topology_newick[topology_hash] = newick
+		derived_topology_splits[topology_hash] = tuple([splits[clade_hash] for clade_hash in topology_hash])
 
-	child1_node = ete2.Tree()
-	child2_node = ete2.Tree()
+	derived_topologies = TopologyProbabilities(derived_topology_newick, derived_topology_splits)
 
-	current_node.add_child(child1_node)
-	current_node.add_child(child2_node)
+	return derived_topologies
 
-	child1_size = clade_size(child1_hash)
-	child2_size = clade_size(child2_hash)
+# the log probability of the most probable resolution of each clade, given conditional clade probabilities
+# clade IDs are ordered by size, so the children of each clade are always resolved before it
+def best_log_completions(cc_set, log_split_probabilities):
+	best_completions = numpy.zeros(cc_set.n_clades, dtype = numpy.float64)
+	for parent_id in range(cc_set.n_clades):
+		split_start = cc_set.split_offsets[parent_id]
+		split_end = cc_set.split_offsets[parent_id + 1]
+		if split_end > split_start:
+			split_completions = log_split_probabilities[split_start:split_end] + best_completions[cc_set.split_child1[split_start:split_end]] + best_completions[cc_set.split_child2[split_start:split_end]]
+			best_completions[parent_id] = split_completions.max()
 
-	if child1_size == 1:
-		child1_node.name = clade_taxon_names(child1_hash, taxon_order)[0]
-	else:
-		derive_tree_from_splits(child1_node, child1_hash, taxon_order, splits)
+	return best_completions
 
-	if child2_size == 1:
-		child2_node.name = clade_taxon_names(child2_hash, taxon_order)[0]
-	else:
-		derive_tree_from_splits(child2_node, child2_hash, taxon_order, splits)
+# the topologies which can be derived from different candidates never overlap, and each candidate can be completed
+# with at least its best completion probability. so if n_required candidates can each be completed with a log
+# probability of at least L, any candidate with a log probability (an upper bound on its completions) below L
+# can never be among the n_required most probable topologies, and can be removed
+def prune_candidates(candidate_heap, n_required):
+	if len(candidate_heap) <= n_required:
+		return candidate_heap
 
-def clade_taxon_names(clade_hash, taxon_order):
-	taxon_names = []
+	lower_bounds = numpy.array([-candidate[0] + candidate[4] for candidate in candidate_heap])
+	required_bound = numpy.partition(lower_bounds, len(lower_bounds) - n_required)[len(lower_bounds) - n_required]
 
-	clade_node_bytes = numpy.array(tuple(clade_hash)).view(dtype = numpy.uint8)
-	clade_node_bits = numpy.unpackbits(clade_node_bytes)
-	n_bits = len(clade_node_bits)
+	pruned_heap = [candidate for candidate in candidate_heap if -candidate[0] >= required_bound]
+	heapq.heapify(pruned_heap)
 
-	for i in range(n_bits):
-		if clade_node_bits[i] == 1:
-			taxon_names.append(taxon_order[i])
+	return pruned_heap
 
-	return taxon_names
+def calculate_root_hash(n_taxa):
+	root_hash = (1 << n_taxa) - 1
 
-def n_derived_topologies(cc_sets, n_taxa, include_zero_probability = False):
-	reverse_ccp = reverse_cc_probabilities(cc_sets)
-	clades_by_size = []
-	n_subtrees = {}
-
-	for i in range(n_taxa - 2):
-		clades_by_size.append(set())
-
-	for clade_hash in cc_sets:
-		n_clade_taxa = clade_size(clade_hash)
-		if n_clade_taxa >= 3:
-			clades_by_size[n_clade_taxa - 3].add(clade_hash)
-
-	for i in range(n_taxa - 2):
-		for parent_hash in clades_by_size[i]:
-			parent_splits = cc_sets[parent_hash]
-			n_parent_subtrees = 0
-			for j in range(parent_splits.n_features):
-				split_hash = parent_splits.hashes_array[j]
-				split_probability = parent_splits.probabilities_array[j]
-				if include_zero_probability or (split_probability > 0.0):
-					child1_hash, child2_hash = elucidate_cc_split(parent_hash, split_hash)
+	return root_hash
 
-					n_split_subtrees = 1
-					child1_size = clade_size(child1_hash)
-					if child1_size > 2:
-						n_split_subtrees = n_split_subtrees * n_subtrees[child1_hash]
+def elucidate_cc_split(parent_id, split_id):
+	child1_id = split_id
+	child2_id = parent_id ^ split_id
 
-					child2_size = clade_size(child2_hash)
-					if child2_size > 2:
-						n_split_subtrees = n_split_subtrees * n_subtrees[child2_hash]
+	return child1_id, child2_id
 
-					n_parent_subtrees += n_split_subtrees
+# builds a newick string with leaf names only (the equivalent of ete2 format 9) from the split of every clade
+# of three or more taxa, writing the first child of each split before the second. a stack of clades still to
+# be written and closing tokens is used instead of recursion, so deep trees never reach the recursion limit
+def newick_from_splits(root_hash, taxon_order, splits):
+	newick_tokens = []
+
+	pending = [root_hash]
+	while len(pending) > 0:
+		clade_hash = pending.pop()
+		if isinstance(clade_hash, str): # a comma or closing bracket
+			newick_tokens.append(clade_hash)
+		elif clade_hash & (clade_hash - 1) == 0: # a single taxon
+			newick_tokens.append(newick_quote(taxon_order[clade_hash.bit_length() - 1]))
+		else:
+			child1_hash, child2_hash = elucidate_cc_split(clade_hash, splits[clade_hash])
+			newick_tokens.append("(")
+			pending.extend([")", child2_hash, ",", child1_hash])
 
-			n_subtrees[parent_hash] = n_parent_subtrees
+	newick_tokens.append(";")
 
-	root_id = calculate_root_hash(n_taxa)
-	n_root_topologies = n_subtrees[root_id]
+	return "".join(newick_tokens)
 
-	return n_root_topologies
+def clade_taxon_names(clade_hash, taxon_order):
+	taxon_names = []
 
-def reverse_cc_probabilities(cc_sets):
-	reverse_ccp = {}
-	for parent_id in cc_sets:
-		for split_id in cc_sets[parent_id].probabilities:
-			cc_probability = cc_sets[parent_id].probabilities[split_id]
-			child1_hash, child2_hash = elucidate_cc_split(parent_id, split_id)
+	remaining_taxa = clade_hash
+	while remaining_taxa != 0:
+		taxon_bit = remaining_taxa & -remaining_taxa
+		taxon_index = taxon_bit.bit_length() - 1
+		taxon_names.append(taxon_order[taxon_index])
+		remaining_taxa ^= taxon_bit
 
-			if child1_hash in reverse_ccp:
-				reverse_ccp[child1_hash][parent_id] = cc_probability
-			else:
-				reverse_ccp[child1_hash] = {parent_id: cc_probability}
+	return taxon_names
 
-			if child2_hash in reverse_ccp:
-				reverse_ccp[child2_hash][parent_id] = cc_probability
-			else:
-				reverse_ccp[child2_hash] = {parent_id: cc_probability}
+def n_derived_topologies(cc_set, n_taxa, include_zero_probability = False):
+	statistics = ccd_statistics(cc_set)
+
+	if include_zero_probability:
+		return statistics["n_topologies"]
+	else:
+		return statistics["n_nonzero_topologies"]
+
+# summary statistics of the distribution of topologies derivable from conditional clades, all calculated in
+# one bottom-up pass. clade IDs are ordered by size, so the statistics of children are always known before
+# those of their parents. clades without splits (single taxa and cherries) can only be resolved one way
+# returns a dictionary with the exact number of derivable topologies with and without zero probability
+# splits, the entropy of the distribution (in nats), the probability of its most probable topology, and the
+# log of its total probability mass (zero when every clade's conditional probabilities sum to one)
+def ccd_statistics(cc_set):
+	# plain lists are much faster than numpy arrays to index one element at a time
+	split_offsets = cc_set.split_offsets.tolist()
+	split_child1 = cc_set.split_child1.tolist()
+	split_child2 = cc_set.split_child2.tolist()
+	split_probabilities = cc_set.split_probabilities.tolist()
+
+	n_subtrees = [1] * cc_set.n_clades # python integers, so counts never overflow
+	n_nonzero_subtrees = [1] * cc_set.n_clades
+	subtree_entropies = [0.0] * cc_set.n_clades
+	best_log_probabilities = [0.0] * cc_set.n_clades
+	log_masses = [0.0] * cc_set.n_clades
+
+	for parent_id in range(cc_set.n_clades):
+		split_start = split_offsets[parent_id]
+		split_end = split_offsets[parent_id + 1]
+		if split_end == split_start:
+			continue
+
+		n_parent_subtrees = 0
+		n_nonzero_parent_subtrees = 0
+		parent_entropy = 0.0
+		split_log_masses = []
+		best_log_probability = float("-inf")
+		for j in range(split_start, split_end):
+			child1_id = split_child1[j]
+			child2_id = split_child2[j]
+			n_parent_subtrees += n_subtrees[child1_id] * n_subtrees[child2_id]
+
+			split_probability = split_probabilities[j]
+			if split_probability > 0.0:
+				n_nonzero_parent_subtrees += n_nonzero_subtrees[child1_id] * n_nonzero_subtrees[child2_id]
+
+				log_split_probability = math.log(split_probability)
+				parent_entropy += split_probability * (subtree_entropies[child1_id] + subtree_entropies[child2_id] - log_split_probability)
+				split_log_masses.append(log_split_probability + log_masses[child1_id] + log_masses[child2_id])
+				best_log_probability = max(best_log_probability, log_split_probability + best_log_probabilities[child1_id] + best_log_probabilities[child2_id])
+
+		n_subtrees[parent_id] = n_parent_subtrees
+		n_nonzero_subtrees[parent_id] = n_nonzero_parent_subtrees
+		subtree_entropies[parent_id] = parent_entropy
+		best_log_probabilities[parent_id] = best_log_probability
+		if len(split_log_masses) > 0:
+			log_masses[parent_id] = numpy.logaddexp.reduce(split_log_masses)
+		else:
+			log_masses[parent_id] = float("-inf")
+
+	root_id = cc_set.root_id
+	statistics = {
+		"n_topologies": n_subtrees[root_id],
+		"n_nonzero_topologies": n_nonzero_subtrees[root_id],
+		"entropy": subtree_entropies[root_id],
+		"map_probability": math.exp(best_log_probabilities[root_id]),
+		"log_total_mass": float(log_masses[root_id]),
+	}
+
+	return statistics
+
+# conditional clade probabilities keyed by child clade hash then by parent clade hash, read from the cached
+# reverse index of the conditional clade table
+def reverse_cc_probabilities(cc_set):
+	cc_set.build_reverse_index()
+
+	reverse_ccp = {}
+	for child_id in range(cc_set.n_clades):
+		reverse_start = cc_set.reverse_offsets[child_id]
+		reverse_end = cc_set.reverse_offsets[child_id + 1]
+		if reverse_start == reverse_end:
+			continue
+
+		parent_probabilities = {}
+		for j in range(reverse_start, reverse_end):
+			parent_hash = cc_set.clade_hashes[cc_set.reverse_parents[j]]
+			parent_probabilities[parent_hash] = cc_set.split_probabilities[cc_set.reverse_splits[j]]
+
+		reverse_ccp[cc_set.clade_hashes[child_id]] = parent_probabilities
 
 	return reverse_ccp
@@ -1,43 +1,123 @@
 #!/usr/bin/python2.7
 
+PROGRAM_VERSION = "nexus_to_newick.py, part of SCCULS preview-1"
+
+import libscculs
+import argparse
+import multiprocessing
 import os
 import sys
-import subprocess
-
-paup_binary = sys.argv[1]
-nexus_paths = sys.argv[2:]
+import time
 
-for nexus_path in nexus_paths:
-	folder_path, file_name = os.path.split(nexus_path)
+# the newick file of a nexus file has the same name with a .newick extension (replacing any compression suffix
+# as well), in the same folder as the nexus file unless output_folder is given
+def newick_path_for(nexus_path, output_folder = None):
+	folder_path, file_name = os.path.split(libscculs.uncompressed_path(nexus_path))
 	base, ext = os.path.splitext(file_name)
 
-	newick_file_name = base + ".newick"
-	newick_file_path = os.path.join(folder_path, newick_file_name)
+	if output_folder is not None:
+		folder_path = output_folder
 
-	paup_file_name = base + ".paup_input"
-	paup_file_path = os.path.join(folder_path, paup_file_name)
+	return os.path.join(folder_path, base + ".newick")
 
-	paup_block = """#NEXUS
+# a newick file is up to date if it was modified after its nexus file
+def is_up_to_date(nexus_path, newick_path):
+	if not os.path.isfile(newick_path):
+		return False
 
-begin paup;
-  Set Maxtrees=100000;
-  GetTrees rooted storeBrLens=yes file=%s;
-  SaveTrees file=%s format=Newick brLens=user root=yes;
-end;
+	return os.path.getmtime(newick_path) >= os.path.getmtime(nexus_path)
 
-quit;
-""" % (file_name, newick_file_name)
+# converts one nexus file to a newick file of one tree per line, discarding burn-in and thinning while reading
+# the newick file is written under a temporary name then renamed, so an interrupted conversion never leaves an
+# incomplete newick file which looks up to date. runs in a worker process, so errors are returned instead of
+# being raised, and the other files are still converted
+# returns (nexus path, newick path, status, number of trees, seconds)
+def convert_file(conversion_job):
+	nexus_path, newick_path, burn_in, thinning, force = conversion_job
+	wall_start = time.time()
 
-	paup_file = open(paup_file_path, "w")
-	paup_file.write(paup_block)
-	paup_file.close()
-
-	paup_cmd = [paup_binary, "-n", paup_file_path]
+	if (not force) and is_up_to_date(nexus_path, newick_path):
+		return nexus_path, newick_path, "skipped", 0, time.time() - wall_start
 
+	n_trees = 0
+	temporary_path = "%s.%d.tmp" % (newick_path, os.getpid())
 	try:
-		paup_result = subprocess.check_output(paup_cmd)
-		print(0)
-		print(paup_result)
-	except CalledProcessError as paup_error:
-		print(paup_error.return_code)
-		print(paup_error.output)
+		newick_file = open(temporary_path, "w")
+		for newick_string in libscculs.iterate_trees(nexus_path, burn_in, thinning):
+			newick_file.write(newick_string + "\n")
+			n_trees += 1
+
+		newick_file.close()
+		if n_trees == 0:
+			raise ValueError("no trees found after discarding burn-in")
+
+		os.rename(temporary_path, newick_path)
+		status = "converted"
+	except Exception as conversion_error:
+		if os.path.exists(temporary_path):
+			os.remove(temporary_path)
+
+		status = "error: " + str(conversion_error)
+
+	return nexus_path, newick_path, status, n_trees, time.time() - wall_start
+
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description = "Converts nexus format MCMC samples to newick format files of one tree per line, using a pool of worker processes. Each newick file has the name of its nexus file with a .newick extension.")
+	arg_parser.add_argument("-v", "--version", action = "version", version = PROGRAM_VERSION)
+	arg_parser.add_argument("-j", "--jobs", type = int, default = 1, help = "The number of worker processes, each of which converts one file at a time. Default: 1.")
+	arg_parser.add_argument("-b", "--burn-in", type = int, default = 0, help = "The number of trees to discard from the beginning of each MCMC sample. Default: 0.")
+	arg_parser.add_argument("-k", "--thin", type = int, default = 1, help = "After discarding burn-in, only keep every k-th tree of each MCMC sample. Default: 1.")
+	arg_parser.add_argument("-f", "--output-folder", type = str, help = "Write newick files to this folder, instead of the folder containing each nexus file.")
+	arg_parser.add_argument("--force", action = "store_true", help = "Convert every file, even if its newick file was modified after the nexus file. Use this after changing -b/--burn-in or -k/--thin.")
+	arg_parser.add_argument("nexus_paths", metavar = "NEXUS_PATH", type = str, nargs = "+", help = "The paths of nexus format MCMC samples, which may be gzip, bzip2 or xz compressed.")
+	args = arg_parser.parse_args()
+
+	if args.jobs <= 0:
+		arg_parser.error("argument -j/--jobs: must be equal to or greater than 1")
+	elif args.burn_in < 0:
+		arg_parser.error("argument -b/--burn-in: must be equal to or greater than 0")
+	elif args.thin <= 0:
+		arg_parser.error("argument -k/--thin: must be equal to or greater than 1")
+	elif (args.output_folder is not None) and (not os.path.isdir(args.output_folder)):
+		arg_parser.error("argument -f/--output-folder: not a folder path")
+	elif not all([os.path.isfile(nexus_path) for nexus_path in args.nexus_paths]):
+		arg_parser.error("argument NEXUS_PATH: not a file path")
+
+	conversion_jobs = [(nexus_path, newick_path_for(nexus_path, args.output_folder), args.burn_in, args.thin, args.force) for nexus_path in args.nexus_paths]
+
+	newick_paths = [conversion_job[1] for conversion_job in conversion_jobs]
+	if len(set(newick_paths)) != len(newick_paths):
+		arg_parser.error("argument NEXUS_PATH: two nexus files would be converted to the same newick file")
+
+	batch_start = time.time()
+	if args.jobs == 1:
+		conversion_results = (convert_file(conversion_job) for conversion_job in conversion_jobs)
+	else:
+		worker_pool = multiprocessing.Pool(args.jobs)
+		conversion_results = worker_pool.imap_unordered(convert_file, conversion_jobs)
+
+	n_converted = 0
+	n_skipped = 0
+	n_failed = 0
+	n_total_trees = 0
+	for nexus_path, newick_path, status, n_trees, seconds in conversion_results:
+		if status == "converted":
+			n_converted += 1
+			n_total_trees += n_trees
+			print("%s -> %s: %i trees in %0.2fs (%0.0f trees/s)" % (nexus_path, newick_path, n_trees, seconds, n_trees / max(seconds, 1e-6)))
+		elif status == "skipped":
+			n_skipped += 1
+			print("%s -> %s: up to date" % (nexus_path, newick_path))
+		else:
+			n_failed += 1
+			print("%s -> %s: %s" % (nexus_path, newick_path, status))
+
+	if args.jobs != 1:
+		worker_pool.close()
+		worker_pool.join()
+
+	batch_seconds = time.time() - batch_start
+	print("Converted %i files (%i trees) in %0.2fs (%0.0f trees/s), %i up to date, %i failed" % (n_converted, n_total_trees, batch_seconds, n_total_trees / max(batch_seconds, 1e-6), n_skipped, n_failed))
+
+	if n_failed > 0:
+		sys.exit(1)
@@ -1,9 +1,13 @@
 PROGRAM_VERSION = "scculs.py, part of SCCULS preview-1"
 
 import libscculs
+import scculs_arguments
 import argparse
 import os
-import csv
+import time
+import multiprocessing
+
+follow_poll_interval = 1.0 # seconds between checks for trees appended to a followed MCMC sample
 
 def safe_open(file_path, overwrite):
 	if (overwrite == False) and os.path.exists(file_path):
@@ -22,144 +26,233 @@ arg_parser = argparse.ArgumentParser(description = "SCCULS: Scalable Conditional
 arg_parser.add_argument("-v", "--version", action = "version", version = PROGRAM_VERSION)
 
 defaults_group = arg_parser.add_argument_group("program defaults")
-defaults_group.add_argument("-c", "--candidate-method", type = str, default = "derived", choices = ["derived", "sampled"], help = "Only consider topologies in the MCMC sample, or derive the most probable topology or topologies using conditional clades. Default: derived.")
-defaults_group.add_argument("-g", "--node-heights", type = str, choices = ["median", "mean"], help = "Specify the method used to calculate node heights. Without this option, node heights will not be calculated, and trees of equal branch lengths will be returned.")
-defaults_group.add_argument("-p", "--probability-method", type = str, choices = ["conditional-clade", "tree-topology"], help = "Infer tree topology probabilities using either tree topology probabilities or conditional clade probabilities. When -c/--candidate-method is 'derived', default is conditional-clade. When -c/--candidate-method is 'sampled', default is tree-topology.")
-defaults_group.add_argument("-s", "--support-values", type = str, choices = ["conditional-clade", "tree-topology"], help = "Add clade monophyly support values to output trees, and infer them using either tree topology frequencies or conditional clade frequencies.")
 
 output_group = arg_parser.add_argument_group('output files')
 output_group.add_argument("-i", "--info-output", metavar = "INFO_OUTPUT_PATH", type = str, help = "Calculate whole-sample statistics and output them to a text format file.")
 output_group.add_argument("-n", "--newick-output", metavar = "NEWICK_OUTPUT_PATH", type = str, help = "Output the summary tree(s) to newick format file(s). When -l/--max-topologies is greater than 1, more than one tree may be returned, so an identifying number will be appended to the end of each filename.")
+output_group.add_argument("-T", "--trees-output", metavar = "TREES_OUTPUT_PATH", type = str, help = "Output all summary trees to a single file, in the same order as the CSV file, with the probability of each tree in a comment before it.")
+output_group.add_argument("--trees-format", type = str, default = "newick", choices = ["newick", "nexus"], help = "The format of the -T/--trees-output file. Newick files have one tree per line. Default: newick.")
+output_group.add_argument("--probability-annotation", type = str, default = "comment", choices = ["comment", "name"], help = "When --trees-format is nexus, write the probability of each tree in a comment, or in the name of the tree. Default: comment.")
 output_group.add_argument("-o", "--csv-output", metavar = "CSV_OUTPUT_PATH", type = str, help = "Calculate statistics for each returned tree topology, and output them to CSV format file.")
+output_group.add_argument("-x", "--counts-output", metavar = "COUNTS_OUTPUT_PATH", type = str, help = "Save the topology, conditional clade and clade counts and node height sums of the MCMC sample to a file. Counts files of independent chains can be summarized together using --merge.")
+output_group.add_argument("--profile", metavar = "PROFILE_PATH", type = str, help = "Record the wall time, CPU time and peak memory use of each stage, along with the sizes of the sample, its conditional clades and the output, and write them to a JSON format file.")
+output_group.add_argument("--profile-cprofile", action = "store_true", help = "When using --profile, also run every stage under cProfile (which slows every stage down), and write the statistics of the slowest stage to PROFILE_PATH.pstats.")
 output_group.add_argument("-w", "--overwrite", action = "store_true", help = "If output file paths point to existing files, overwrite the existing files.")
 
 limits_group = arg_parser.add_argument_group('output limits')
-limits_group.add_argument("-l", "--max-topologies", type = int, default = 1, help = "The size of the credible set in the number of unique topologies to output. The number of topologies returned will still be limited by -m/--max-probability. Default: 1.")
-limits_group.add_argument("-m", "--max-probability", type = float, default = 1.0, help = "The size of the credible set in total posterior probability to output. The number of topologies returned will still be limited by -l/--max-topologies. Default: 1.0")
 
 input_group = arg_parser.add_argument_group('program input')
-input_group.add_argument("-b", "--burn-in", type = int, default = 0, help = "The number of trees to discard from the beginning of the MCMC sample. Default: 0.")
-input_group.add_argument("-d", "--calibration-date", type = float, default = 0.0, help = "If any tip dates are not contemporary (including tip date sampling), set a fixed date for the calibration taxon so that the tree height is correctly calculated. Negative numbers are used for past dates, positive numbers for future dates. Default: 0.0.")
-input_group.add_argument("-t", "--calibration-taxon", type = str, default = "", help = "If any tip dates are not contemporary (including tip date sampling), set the calibration taxon so that the tree height is correctly calculated.")
-input_group.add_argument("sample_path", metavar = "MCMC_SAMPLE_PATH", type = str, help = "The path to an MCMC sample of phylogenetic trees in either nexus or newick format.")
+scculs_arguments.add_summary_arguments(defaults_group, limits_group, input_group)
+
+input_group.add_argument("-j", "--jobs", type = int, default = 1, help = "The number of worker processes used to read and count the MCMC sample. Default: 1.")
+input_group.add_argument("--cache-folder", type = str, help = "Store parsed MCMC samples in this folder, instead of the folder containing the MCMC sample. Later runs with the same MCMC sample and the same -b/--burn-in, -k/--thin, -d/--calibration-date and -t/--calibration-taxon settings load the parsed sample from the cache.")
+input_group.add_argument("--no-cache", action = "store_true", help = "Do not read or write a cache of the parsed MCMC sample.")
+input_group.add_argument("--decompress-process", action = "store_true", help = "Decompress a gzip or bzip2 compressed MCMC sample using the gzip or bzip2 program in a separate process, so decompression overlaps with reading trees. xz compressed samples are always decompressed by the xz program. Compressed samples are recognized by their contents or by a .gz, .bz2 or .xz suffix.")
+input_group.add_argument("--follow", action = "store_true", help = "Keep reading trees as they are appended to an MCMC sample by a running chain, and write updated outputs (replacing earlier outputs) until interrupted. Conditional clade probabilities, derived topologies and mean node heights are updated incrementally, while clade probabilities, sample statistics and median node heights are recalculated for every update. The sample cache is not used.")
+input_group.add_argument("--follow-interval", type = float, default = 300.0, help = "When following an MCMC sample, the minimum number of seconds between updated outputs. Default: 300.")
+input_group.add_argument("--follow-trees", type = int, help = "When following an MCMC sample, write updated outputs every time this many new trees have been read, instead of after --follow-interval seconds.")
+input_group.add_argument("--merge", action = "store_true", help = "Instead of an MCMC sample, summarize the merged counts of one or more counts files written using -x/--counts-output. Counts files must have been written with the same -t/--calibration-taxon and -d/--calibration-date, but may differ in burn-in and thinning. Only mean node heights can be calculated from counts files.")
+input_group.add_argument("sample_paths", metavar = "MCMC_SAMPLE_PATH", type = str, nargs = "+", help = "The path to an MCMC sample of phylogenetic trees in either nexus or newick format, or with --merge, the paths of counts files.")
 
 args = arg_parser.parse_args()
 
 # raise errors in response to incomplete or nonsensical user-supplied arguments
-if args.max_topologies <= 0:
-	arg_parser.error("argument -l/--max-topologies: must be equal to or greater than 1")
-elif args.max_probability <= 0.0 or args.max_probability > 1.0:
-	arg_parser.error("argument -m/--max-probability: must be greater than 0.0 and less than 1.0")
-elif not os.path.isfile(args.sample_path):
+settings_error = scculs_arguments.check_summary_settings(args)
+if settings_error is not None:
+	arg_parser.error(settings_error)
+elif args.jobs <= 0:
+	arg_parser.error("argument -j/--jobs: must be equal to or greater than 1")
+elif (not args.merge) and (len(args.sample_paths) > 1):
+	arg_parser.error("argument MCMC_SAMPLE_PATH: only one MCMC sample can be summarized, unless --merge is used")
+elif not all([os.path.isfile(sample_path) for sample_path in args.sample_paths]):
 	arg_parser.error("argument MCMC_SAMPLE_PATH: not a file path")
-
-# set probability method
-if args.probability_method is None: # defaults if not supplied
-	if args.candidate_method == "derived":
-		probability_method = "conditional-clade"
-	else:
-		probability_method = "tree-topology"
-else: # user-supplied method
-	probability_method = args.probability_method
+elif args.merge and args.follow:
+	arg_parser.error("argument --merge: not allowed with argument --follow")
+elif (args.probability_annotation == "name") and (args.trees_format != "nexus"):
+	arg_parser.error("argument --probability-annotation: name requires --trees-format nexus")
+elif args.profile_cprofile and (args.profile is None):
+	arg_parser.error("argument --profile-cprofile: requires argument --profile")
+elif args.merge and (args.node_heights == "median"):
+	arg_parser.error("argument --merge: only mean node heights can be calculated from counts files")
+elif args.follow and (libscculs.compression_format(args.sample_paths[0]) is not None):
+	arg_parser.error("argument --follow: compressed MCMC samples cannot be followed")
+elif (args.cache_folder is not None) and (not os.path.isdir(args.cache_folder)):
+	arg_parser.error("argument --cache-folder: not a folder path")
+elif args.follow_interval < 0.0:
+	arg_parser.error("argument --follow-interval: must be equal to or greater than 0.0")
+elif (args.follow_trees is not None) and (args.follow_trees <= 0):
+	arg_parser.error("argument --follow-trees: must be equal to or greater than 1")
 
 calibration_taxon = args.calibration_taxon
 calibration_date = args.calibration_date
-sample_path = args.sample_path
+sample_path = args.sample_paths[0]
 sample_burn_in = args.burn_in
+sample_thinning = args.thin
+n_jobs = args.jobs
 max_tree_topologies = args.max_topologies
 max_probability = args.max_probability
 overwrite = args.overwrite
 
-print "Reading MCMC sample..."
-mcmc_sample = libscculs.trees_from_path(sample_path)
-mcmc_post = mcmc_sample[sample_burn_in:] # discard burn-in
-ultrametric_sample = libscculs.UltrametricSample(mcmc_post, calibration_taxon, calibration_date)
-taxon_order = ultrametric_sample.taxon_order
-n_taxa = len(taxon_order)
-
-print("Counting topologies and conditional clades...")
-topology_set, topology_counts, cc_sets, cc_counts, clade_set = libscculs.calculate_topology_probabilities(ultrametric_sample)
-n_unique_topologies = topology_set.n_features
-
-# all circumstances where conditional clade probabilities are required
-# don't bother to calculate if not needed
-if (args.candidate_method == "derived") or (probability_method == "conditional-clade") or (args.support_values == "conditional-clade"):
-	print("Calculating conditional clade probabilities...")
-	for parent_hash, split_counts in cc_counts.items():
-		cc_sets[parent_hash].probabilities_from_counts(split_counts)
-
-# adding tree-topology based support values needs to be done before other steps, in case the topology set is modified later
-if args.support_values == "conditional-clade":
-	print("Calculating clade probabilities from conditional clade probabilities...")
-	clade_set.derive_clade_probabilities(cc_sets, n_taxa)
-elif args.support_values == "tree-topology":
-	print("Calculating topology and clade probabilities from MCMC sample...")
-	topology_set.probabilities_from_counts(topology_counts)
-	clade_set.melt_clade_probabilities(topology_set, n_taxa)
-
-if args.candidate_method == "derived": # derive credible topologies from conditional clades
-	print("Deriving probable topologies from conditional clades...")
-	output_topology_set = libscculs.derive_best_topologies(cc_sets, taxon_order, max_tree_topologies, max_probability)
-else: # base credible topologies on frequency in MCMC sample
-	output_topology_set = topology_set
-
-if probability_method == "conditional-clade":
-	print("Calculating topology probabilities from conditional clade probabilities...")
-	output_topology_set.probabilities_from_ccs(cc_sets)
+# written to counts files, and replaced by the settings of the merged counts files when using --merge
+counts_settings = libscculs.sample_settings(sample_burn_in, sample_thinning, calibration_taxon, calibration_date)
+
+stage_profiler = libscculs.StageProfiler(args.profile_cprofile)
+
+# prints what the next stage of the run is, and starts timing it
+def start_stage(stage_message, stage_name):
+	print(stage_message)
+	stage_profiler.start_stage(stage_name)
+
+# writes every output file of a sample, each of which only calculates the stages it needs
+# a conditional clade table whose probabilities are already calculated may be passed as cc_set, along with the
+# derivations already found from it as topology_derivations, so they are not recalculated from scratch
+def summarize_sample(ultrametric_sample, cc_set = None, topology_derivations = None):
+	summarizer = libscculs.Summarizer(ultrametric_sample, candidate_method = args.candidate_method, derivation_method = args.derivation_method, probability_method = args.probability_method, support_method = args.support_values, node_heights = args.node_heights, exact_heights = args.exact_heights, max_topologies = max_tree_topologies, max_probability = max_probability, prune_frontier = args.prune_frontier, cc_set = cc_set, topology_derivations = topology_derivations, stage_callback = start_stage)
+
+	if args.counts_output is not None:
+		start_stage("Writing counts file...", "counts_output")
+		if (overwrite == False) and os.path.exists(args.counts_output):
+			raise Exception("This file already exists: " + args.counts_output)
+
+		libscculs.save_counts(ultrametric_sample, args.counts_output, counts_settings)
+
+	if args.info_output is not None:
+		if args.candidate_method == "derived":
+			summarizer.ccd_statistics()
+
+		start_stage("Writing MCMC sample statistics file...", "info_output")
+		info_output_file = safe_open(args.info_output, overwrite)
+		summarizer.write_info(info_output_file)
+		info_output_file.close()
+
+	if args.newick_output is not None:
+		output_topology_set = summarizer.output_topologies()
+		start_stage("Writing tree topology files...", "newick_output")
+		newick_path_prefix = args.newick_output
+		for i in range(output_topology_set.n_features):
+			newick_string = output_topology_set.data_array[i]
+			newick_output_path = newick_path_prefix + "." + str(i)
+			newick_output_file = safe_open(newick_output_path, overwrite)
+			newick_output_file.write(newick_string + "\n")
+			newick_output_file.close()
+
+	if args.trees_output is not None:
+		summarizer.output_topologies()
+		start_stage("Writing summary trees file...", "trees_output")
+		trees_output_file = safe_open(args.trees_output, overwrite)
+		summarizer.write_trees(trees_output_file, args.trees_format, args.probability_annotation)
+		trees_output_file.close()
+
+	if args.csv_output is not None:
+		summarizer.output_topologies()
+		start_stage("Writing tree statistics file...", "csv_output")
+		csv_output_file = safe_open(args.csv_output, overwrite)
+		summarizer.write_csv(csv_output_file)
+		csv_output_file.close()
+
+	stage_profiler.end_stage()
+	if summarizer.frontier_telemetry is not None:
+		frontier_columns = ["iteration", "frontier_size", "n_topologies", "frontier_probability", "topologies_probability"]
+		stage_profiler.record("frontier", [dict(zip(frontier_columns, frontier_row)) for frontier_row in summarizer.frontier_telemetry])
+	for name, value in summarizer.cardinalities().items():
+		stage_profiler.record(name, value)
+	if args.profile is not None:
+		stage_profiler.write_json(args.profile)
+
+if args.follow:
+	# counts, conditional clade probabilities and derivations are kept between summaries, and only updated with
+	# trees appended to the sample since the last summary
+	follower = libscculs.TreeFileFollower(sample_path, sample_burn_in, sample_thinning)
+	ultrametric_sample = libscculs.UltrametricSample([], calibration_taxon, calibration_date)
+	cc_set = None
+	topology_derivations = None
+	changed_clades = set()
+	n_summarized_trees = 0
+	last_summary_time = None
+
+	# one pool of workers is kept for the whole run, instead of one for each batch of appended trees
+	follow_pool = None
+	if n_jobs > 1:
+		follow_pool = multiprocessing.Pool(n_jobs)
+
+	print("Following MCMC sample, press Ctrl-C to stop...")
+	try:
+		while True:
+			try:
+				changed_clades.update(ultrametric_sample.add_trees(follower.read_new_trees(), calibration_taxon, calibration_date, n_jobs, worker_pool = follow_pool))
+			except libscculs.CalibrationTaxonError as calibration_error:
+				arg_parser.error("argument -t/--calibration-taxon: " + str(calibration_error))
+
+			n_new_trees = ultrametric_sample.n_trees - n_summarized_trees
+
+			if args.follow_trees is not None:
+				summary_due = n_new_trees >= args.follow_trees
+			else:
+				summary_due = (n_new_trees > 0) and ((last_summary_time is None) or (time.time() - last_summary_time >= args.follow_interval))
+
+			if summary_due:
+				print("Summarizing %i trees..." % (ultrametric_sample.n_trees))
+				changed_ids = None
+				if cc_set is not None:
+					changed_ids = cc_set.update_counts(ultrametric_sample.cc_counts, changed_clades)
+
+				if changed_ids is None: # new clades or splits were sampled, so the table is rebuilt
+					n_taxa = len(ultrametric_sample.taxon_order)
+					cc_set = libscculs.ConditionalCladeProbabilities(ultrametric_sample.cc_counts, n_taxa)
+					cc_set.probabilities_from_counts()
+					topology_derivations = None
+					if (args.candidate_method == "derived") and (args.derivation_method == "k-best"):
+						topology_derivations = libscculs.TopologyDerivations(cc_set)
+				elif topology_derivations is not None:
+					topology_derivations.update_clades(changed_ids)
+
+				summarize_sample(ultrametric_sample, cc_set, topology_derivations)
+				changed_clades = set()
+				n_summarized_trees = ultrametric_sample.n_trees
+				last_summary_time = time.time()
+				overwrite = True # later summaries replace the output files of earlier summaries
+
+			time.sleep(follow_poll_interval)
+	except KeyboardInterrupt:
+		print("Stopped following MCMC sample")
+	finally:
+		if follow_pool is not None:
+			follow_pool.terminate()
+			follow_pool.join()
+elif args.merge:
+	start_stage("Merging counts files...", "merging")
+	try:
+		ultrametric_sample, counts_settings = libscculs.merge_counts(args.sample_paths)
+	except ValueError as merge_error:
+		arg_parser.error("argument MCMC_SAMPLE_PATH: " + str(merge_error))
+
+	summarize_sample(ultrametric_sample)
 else:
-	print("Calculating topology probabilities...")
-	output_topology_set.probabilities_from_counts(topology_counts)
-
-# once probabilities have been calculated for each topology in the sampled set
-# then topologies that exceed maximum topology/probability limits can be removed
-if args.candidate_method == "sampled":
-	print("Limiting output topologies to credible set...")
-	output_topology_set.cull_probabilities(max_tree_topologies, max_probability)
-
-if args.support_values is not None:
-	print("Adding clade support values to tree topologies...")
-	output_topology_set.add_clade_support(clade_set, taxon_order)
-
-if args.info_output is not None:
-	print("Writing MCMC sample statistics file...")
-	info_output_path = args.info_output
-	info_output_file = safe_open(info_output_path, overwrite)
-	info_output_file.write("Number of taxa in each tree: %i\n" % (n_taxa))
-	info_output_file.write("Number of unique tree topologies in MCMC sample: %i\n" % (n_unique_topologies))
-
-	if args.candidate_method == "derived": # calculate summary statistics for topologies
-		n_nonzero_topologies = libscculs.n_derived_topologies(cc_sets, n_taxa)
-		info_output_file.write("Number of topologies derived from conditional clades: %i\n" % (n_nonzero_topologies))
-
-		#n_derived_topologies = libscculs.n_derived_topologies(cc_sets, n_taxa, include_zero_probability = True)
-		#n_nonzero_topologies = libscculs.n_derived_topologies(cc_sets, n_taxa)
-		#info_output_file.write("Number of topologies derived from conditional clades: %i\n" % (n_derived_topologies))
-		#info_output_file.write("Number of topologies derived from conditional clades (with non-zero probabilities): %i\n" % (n_nonzero_topologies))
-
-	info_output_file.close()
-
-if args.newick_output is not None:
-	print("Writing tree topology files...")
-	newick_path_prefix = args.newick_output
-	for i in range(output_topology_set.n_features):
-		newick_string = output_topology_set.data_array[i]
-		newick_output_path = newick_path_prefix + "." + str(i)
-		newick_output_file = safe_open(newick_output_path, overwrite)
-		newick_output_file.write(newick_string + "\n")
-		newick_output_file.close()
-
-if args.csv_output is not None:
-	print("Writing tree statistics file...")
-	csv_output_path = args.csv_output
-	csv_output_file = safe_open(csv_output_path, overwrite)
-	csv_writer = csv.writer(csv_output_file)
-
-	header_row = ["topology", "probability"]
-	csv_writer.writerow(header_row)
-
-	for i in range(output_topology_set.n_features):
-		topology_probability = output_topology_set.probabilities_array[i]
-		output_row = [i, topology_probability]
-		csv_writer.writerow(output_row)
-
-	csv_output_file.close()
+	ultrametric_sample = None
+	if not args.no_cache:
+		cache_key = libscculs.sample_cache_key(sample_path, sample_burn_in, sample_thinning, calibration_taxon, calibration_date)
+		cache_path = libscculs.sample_cache_path(sample_path, cache_key, args.cache_folder)
+		stage_profiler.start_stage("reading_cache")
+		ultrametric_sample = libscculs.load_sample_cache(cache_path, cache_key)
+		if ultrametric_sample is not None:
+			print("Reading cached MCMC sample...")
+
+	if ultrametric_sample is None:
+		start_stage("Reading MCMC sample...", "reading")
+		mcmc_post = libscculs.iterate_trees(sample_path, sample_burn_in, sample_thinning, args.decompress_process) # discard burn-in while reading
+		try:
+			ultrametric_sample = libscculs.UltrametricSample(mcmc_post, calibration_taxon, calibration_date, n_jobs)
+		except libscculs.CalibrationTaxonError as calibration_error:
+			arg_parser.error("argument -t/--calibration-taxon: " + str(calibration_error))
+
+		if ultrametric_sample.n_trees == 0:
+			arg_parser.error("argument -b/--burn-in: no trees remain after discarding burn-in")
+
+		if not args.no_cache:
+			stage_profiler.start_stage("writing_cache")
+			try:
+				libscculs.save_sample_cache(ultrametric_sample, cache_path, cache_key)
+			except (IOError, OSError) as cache_error:
+				print("Could not write MCMC sample cache: " + str(cache_error))
+
+	summarize_sample(ultrametric_sample)
@@ -0,0 +1,32 @@
+# the summary options shared by scculs.py and scculs_batch.py, so both programs offer the same options with the
+# same help, defaults and choices. scculs.py sorts them into argument groups, scculs_batch.py passes the same parser
+# or group for every group (including the parser of each manifest line)
+def add_summary_arguments(defaults_group, limits_group, input_group):
+	defaults_group.add_argument("-c", "--candidate-method", type = str, default = "derived", choices = ["derived", "sampled"], help = "Only consider topologies in the MCMC sample, or derive the most probable topology or topologies using conditional clades. Default: derived.")
+	defaults_group.add_argument("-a", "--derivation-method", type = str, default = "k-best", choices = ["k-best", "best-first"], help = "When -c/--candidate-method is 'derived', either enumerate the most probable topologies exactly using dynamic programming, or search for them using a best-first search. Default: k-best.")
+	defaults_group.add_argument("-g", "--node-heights", type = str, choices = ["median", "mean"], help = "Specify the method used to calculate node heights. Leaves are placed at the mean sampled height of their taxon, so tip dates are kept. Without this option, node heights will not be calculated, and trees of equal branch lengths will be returned.")
+	defaults_group.add_argument("--exact-heights", action = "store_true", help = "When -g/--node-heights is median, calculate exact medians by keeping every height of the output clades in memory, instead of estimating the medians of often sampled clades from a fixed-size histogram of the heights of each clade.")
+	defaults_group.add_argument("-p", "--probability-method", type = str, choices = ["conditional-clade", "tree-topology"], help = "Infer tree topology probabilities using either tree topology probabilities or conditional clade probabilities. When -c/--candidate-method is 'derived', default is conditional-clade. When -c/--candidate-method is 'sampled', default is tree-topology.")
+	defaults_group.add_argument("-s", "--support-values", type = str, choices = ["conditional-clade", "tree-topology"], help = "Add clade monophyly support values to output trees, and infer them using either tree topology frequencies or conditional clade frequencies.")
+
+	limits_group.add_argument("-l", "--max-topologies", type = int, default = 1, help = "The size of the credible set in the number of unique topologies to output. The number of topologies returned will still be limited by -m/--max-probability. Default: 1.")
+	limits_group.add_argument("-m", "--max-probability", type = float, default = 1.0, help = "The size of the credible set in total posterior probability to output. The number of topologies returned will still be limited by -l/--max-topologies. Default: 1.0")
+	limits_group.add_argument("--prune-frontier", action = "store_true", help = "When deriving topologies from conditional clades using a best-first search, periodically discard partial topologies that cannot be among the -l/--max-topologies most probable topologies. This bounds memory use when deriving large credible sets.")
+
+	input_group.add_argument("-b", "--burn-in", type = int, default = 0, help = "The number of trees to discard from the beginning of the MCMC sample. Default: 0.")
+	input_group.add_argument("-k", "--thin", type = int, default = 1, help = "After discarding burn-in, only keep every k-th tree of the MCMC sample. Default: 1.")
+	input_group.add_argument("-d", "--calibration-date", type = float, default = 0.0, help = "If any tip dates are not contemporary (including tip date sampling), set a fixed date for the calibration taxon so that the tree height is correctly calculated. Negative numbers are used for past dates, positive numbers for future dates. Default: 0.0.")
+	input_group.add_argument("-t", "--calibration-taxon", type = str, default = "", help = "If any tip dates are not contemporary (including tip date sampling), set the calibration taxon so that the tree height is correctly calculated.")
+
+# returns an error message for nonsensical summary settings, or None
+def check_summary_settings(settings):
+	if settings.max_topologies <= 0:
+		return "argument -l/--max-topologies: must be equal to or greater than 1"
+	elif settings.max_probability <= 0.0 or settings.max_probability > 1.0:
+		return "argument -m/--max-probability: must be greater than 0.0 and less than 1.0"
+	elif settings.burn_in < 0:
+		return "argument -b/--burn-in: must be equal to or greater than 0"
+	elif settings.thin <= 0:
+		return "argument -k/--thin: must be equal to or greater than 1"
+
+	return None
@@ -0,0 +1,196 @@
+#!/usr/bin/python2.7
+
+PROGRAM_VERSION = "scculs_batch.py, part of SCCULS preview-1"
+
+import libscculs
+import scculs_arguments
+import argparse
+import csv
+import multiprocessing
+import os
+import shlex
+import sys
+import time
+
+# the columns of the combined statistics file, one row per MCMC sample
+statistics_columns = ["sample_path", "output_prefix", "status", "n_taxa", "n_trees", "n_unique_topologies", "n_clades", "n_conditional_clades", "n_output_topologies", "top_probability", "ccd_entropy", "ccd_map_probability", "wall"]
+
+# each line of the manifest is the path of an MCMC sample, optionally followed by summary options which replace the
+# batch settings for that sample, and --output-name to name its output files. blank lines and lines beginning with #
+# are ignored, and relative paths are relative to the folder containing the manifest
+# returns a list of (sample path, output name, settings) tuples
+def read_manifest(manifest_path, batch_settings):
+	manifest_folder = os.path.dirname(os.path.abspath(manifest_path))
+	manifest_entries = []
+
+	manifest_file = open(manifest_path)
+	for line_number, manifest_line in enumerate(manifest_file, 1):
+		if manifest_line.strip() == "" or manifest_line.lstrip().startswith("#"):
+			continue
+
+		line_parser = argparse.ArgumentParser(prog = "%s line %d" % (manifest_path, line_number), add_help = False)
+		scculs_arguments.add_summary_arguments(line_parser, line_parser, line_parser)
+		line_parser.add_argument("--output-name", type = str)
+		line_parser.add_argument("sample_path", type = str)
+		line_parser.set_defaults(**vars(batch_settings))
+
+		line_settings = line_parser.parse_args(shlex.split(manifest_line))
+		settings_error = scculs_arguments.check_summary_settings(line_settings)
+		if settings_error is not None:
+			line_parser.error(settings_error)
+
+		sample_path = os.path.normpath(os.path.join(manifest_folder, line_settings.sample_path))
+		if not os.path.isfile(sample_path):
+			line_parser.error("argument MCMC_SAMPLE_PATH: not a file path")
+
+		output_name = line_settings.output_name
+		if output_name is None:
+			output_name = os.path.splitext(os.path.basename(sample_path))[0]
+
+		manifest_entries.append((sample_path, output_name, line_settings))
+
+	manifest_file.close()
+
+	return manifest_entries
+
+def open_output(file_path, overwrite):
+	if (overwrite == False) and os.path.exists(file_path):
+		raise IOError("This file already exists: " + file_path)
+
+	return open(file_path, "w")
+
+def read_sample(sample_path, settings, use_cache, cache_folder):
+	ultrametric_sample = None
+	if use_cache:
+		cache_key = libscculs.sample_cache_key(sample_path, settings.burn_in, settings.thin, settings.calibration_taxon, settings.calibration_date)
+		cache_path = libscculs.sample_cache_path(sample_path, cache_key, cache_folder)
+		ultrametric_sample = libscculs.load_sample_cache(cache_path, cache_key)
+
+	if ultrametric_sample is None:
+		mcmc_post = libscculs.iterate_trees(sample_path, settings.burn_in, settings.thin)
+		ultrametric_sample = libscculs.UltrametricSample(mcmc_post, settings.calibration_taxon, settings.calibration_date)
+		if ultrametric_sample.n_trees == 0:
+			raise ValueError("no trees remain after discarding burn-in")
+
+		if use_cache:
+			try:
+				libscculs.save_sample_cache(ultrametric_sample, cache_path, cache_key)
+			except (IOError, OSError):
+				pass
+
+	return ultrametric_sample
+
+# summarizes one MCMC sample and writes its info, newick and CSV files, which are named after output_prefix
+# runs in a worker process, so errors are returned in the statistics row instead of being raised, and the
+# rest of the batch carries on
+def summarize_file(file_job):
+	entry_index, sample_path, output_prefix, settings, use_cache, cache_folder, overwrite = file_job
+	wall_start = time.time()
+
+	statistics_row = {"sample_path": sample_path, "output_prefix": output_prefix, "status": "ok"}
+	try:
+		ultrametric_sample = read_sample(sample_path, settings, use_cache, cache_folder)
+		summarizer = libscculs.Summarizer(ultrametric_sample, candidate_method = settings.candidate_method, derivation_method = settings.derivation_method, probability_method = settings.probability_method, support_method = settings.support_values, node_heights = settings.node_heights, exact_heights = settings.exact_heights, max_topologies = settings.max_topologies, max_probability = settings.max_probability, prune_frontier = settings.prune_frontier)
+
+		info_output_file = open_output(output_prefix + ".info", overwrite)
+		summarizer.write_info(info_output_file)
+		info_output_file.close()
+
+		output_topology_set = summarizer.output_topologies()
+		for i in range(output_topology_set.n_features):
+			newick_output_file = open_output(output_prefix + ".newick." + str(i), overwrite)
+			newick_output_file.write(output_topology_set.data_array[i] + "\n")
+			newick_output_file.close()
+
+		csv_output_file = open_output(output_prefix + ".csv", overwrite)
+		summarizer.write_csv(csv_output_file)
+		csv_output_file.close()
+
+		statistics_row.update(summarizer.cardinalities())
+		if output_topology_set.n_features > 0:
+			statistics_row["top_probability"] = output_topology_set.probabilities_array.max()
+		if summarizer.statistics is not None:
+			statistics_row["ccd_entropy"] = summarizer.statistics["entropy"]
+			statistics_row["ccd_map_probability"] = summarizer.statistics["map_probability"]
+	except Exception as summary_error:
+		statistics_row["status"] = "error: " + str(summary_error)
+
+	statistics_row["wall"] = time.time() - wall_start
+
+	return entry_index, statistics_row
+
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(description = "Summarizes many MCMC samples listed in a manifest file in one run, using a pool of worker processes which each summarize one sample after another. Writes the info, newick and CSV files of each sample, and a combined CSV file of the statistics of every sample.")
+	arg_parser.add_argument("-v", "--version", action = "version", version = PROGRAM_VERSION)
+
+	defaults_group = arg_parser.add_argument_group("summary settings (can be changed for each MCMC sample in the manifest)")
+	scculs_arguments.add_summary_arguments(defaults_group, defaults_group, defaults_group)
+
+	batch_group = arg_parser.add_argument_group("batch settings")
+	batch_group.add_argument("-j", "--jobs", type = int, default = 1, help = "The number of worker processes, each of which summarizes one MCMC sample at a time. Default: 1.")
+	batch_group.add_argument("-f", "--output-folder", type = str, default = ".", help = "The folder in which to write the output files of each MCMC sample, which are named after the sample file (without its extension) or after the --output-name given in the manifest. Default: the current folder.")
+	batch_group.add_argument("--statistics-output", metavar = "STATISTICS_OUTPUT_PATH", type = str, help = "The path of the combined CSV file of per-sample statistics. Default: statistics.csv in the output folder.")
+	batch_group.add_argument("-w", "--overwrite", action = "store_true", help = "If output file paths point to existing files, overwrite the existing files.")
+	batch_group.add_argument("--cache-folder", type = str, help = "Store parsed MCMC samples in this folder, instead of the folder containing each MCMC sample.")
+	batch_group.add_argument("--no-cache", action = "store_true", help = "Do not read or write caches of the parsed MCMC samples.")
+	batch_group.add_argument("manifest_path", metavar = "MANIFEST_PATH", type = str, help = "A text file listing one MCMC sample path per line, each optionally followed by summary options and --output-name NAME.")
+
+	args = arg_parser.parse_args()
+
+	settings_error = scculs_arguments.check_summary_settings(args)
+	if settings_error is not None:
+		arg_parser.error(settings_error)
+	elif args.jobs <= 0:
+		arg_parser.error("argument -j/--jobs: must be equal to or greater than 1")
+	elif not os.path.isfile(args.manifest_path):
+		arg_parser.error("argument MANIFEST_PATH: not a file path")
+	elif not os.path.isdir(args.output_folder):
+		arg_parser.error("argument -f/--output-folder: not a folder path")
+	elif (args.cache_folder is not None) and (not os.path.isdir(args.cache_folder)):
+		arg_parser.error("argument --cache-folder: not a folder path")
+
+	manifest_entries = read_manifest(args.manifest_path, args)
+
+	output_names = [output_name for sample_path, output_name, settings in manifest_entries]
+	if len(set(output_names)) != len(output_names):
+		arg_parser.error("argument MANIFEST_PATH: two MCMC samples have the same output name, so set --output-name for one of them")
+
+	statistics_output_path = args.statistics_output
+	if statistics_output_path is None:
+		statistics_output_path = os.path.join(args.output_folder, "statistics.csv")
+
+	statistics_output_file = open_output(statistics_output_path, args.overwrite)
+
+	file_jobs = []
+	for entry_index, (sample_path, output_name, settings) in enumerate(manifest_entries):
+		output_prefix = os.path.join(args.output_folder, output_name)
+		file_jobs.append((entry_index, sample_path, output_prefix, settings, not args.no_cache, args.cache_folder, args.overwrite))
+
+	# each worker imports libscculs once, and is then reused for one MCMC sample after another
+	statistics_rows = [None] * len(file_jobs)
+	if args.jobs == 1:
+		file_results = (summarize_file(file_job) for file_job in file_jobs)
+	else:
+		worker_pool = multiprocessing.Pool(args.jobs)
+		file_results = worker_pool.imap_unordered(summarize_file, file_jobs)
+
+	n_failed = 0
+	for n_finished, (entry_index, statistics_row) in enumerate(file_results, 1):
+		statistics_rows[entry_index] = statistics_row
+		if statistics_row["status"] != "ok":
+			n_failed += 1
+
+		print("Summarized %i of %i MCMC samples (%0.2fs): %s %s" % (n_finished, len(file_jobs), statistics_row["wall"], statistics_row["sample_path"], statistics_row["status"]))
+
+	if args.jobs != 1:
+		worker_pool.close()
+		worker_pool.join()
+
+	csv_writer = csv.DictWriter(statistics_output_file, statistics_columns)
+	csv_writer.writeheader()
+	csv_writer.writerows(statistics_rows)
+	statistics_output_file.close()
+
+	if n_failed > 0:
+		sys.stderr.write("%i of %i MCMC samples could not be summarized\n" % (n_failed, len(file_jobs)))
+		sys.exit(1)